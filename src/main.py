@@ -41,14 +41,20 @@ to any 3rd-party components used within.
 import os
 import sys
 from dataclasses import (dataclass, field)
-from threading import (Thread, Event)
+from threading import (Thread, Event, Timer, Lock)
 from argparse import (ArgumentParser, SUPPRESS as APSUPPRESS)
 from logging import (getLogger, Formatter, NullHandler, FileHandler, StreamHandler, DEBUG, INFO, WARNING)
 from datetime import datetime
-from modules.TouchPortalAPI import (Client, TYPES as TPTYPES)
+from functools import lru_cache
+from multiprocessing import freeze_support
+from modules.TouchPortalAPI import (Client, TYPES as TPTYPES, PRIORITY as TPPRIORITY)
 from modules.utils import Logger
-from modules.profile_parser import GameProfileParser
-from modules.profile_watcher import WatcherThread
+from modules.profile_parser import (GameProfileParser, GK_DEV_DATA_MAP)
+from modules.profile_cache import ProfileCache
+from modules.profile_store import (ProfileRegistry, ProfileLRU)
+from modules.profile_watcher import (WatcherService, ChangeSet)
+from modules.command_queue import CommandQueue
+from modules.state_snapshot import StateSnapshot
 if sys.platform == "win32":
 	from modules.lgsdi import LGSDInterface
 
@@ -63,6 +69,7 @@ GK_SET_AUTO_SWTCH = "Auto-switch Profiles"
 GK_SET_USE_LGSDI = "Use LGS Script Integration"
 GK_SET_SEND_BTN_STATES = "Report Button Presses"
 GK_SET_POLL_INTRVL = "Profile Change Poll Interval (ms)"
+GK_SET_ADAPTIVE_POLL = "Adaptive Profile Polling"
 GK_SET_UNMAPPED_SLOT = "Unmapped Button Text"
 GK_SET_LAST_PROF = "Last Active Profile"
 GK_ACT_SWITCH_PROF = GK_PLUGIN_ID + ".act.switchProfile"
@@ -88,16 +95,9 @@ if sys.platform == "win32":
 elif sys.platform == "darwin":
 	GK_DEFAULT_LGS_PROFILE_PATH = os.path.expanduser("~/Library/Application Support/Logitech")
 else:
-	sys.exit(f"Unsupported/unknown platform: {sys.platform}")
-
-# device name : (max keys, max states, profile contextId prefix, the LGS "family" code and suffix for TP State id)
-GK_DEV_DATA_MAP = {
-	"Keyboard"             : (18, 3, "G",      "kb"),
-	"LeftHandedController" : (29, 3, "G",      "lhc"),
-	"Mouse"                : (20, 1, "Button", "mouse"),
-	"Headset"              : ( 3, 1, "G",      "hs")  # not sure of "G"
-}
-# inverse mapping of the above, to index device types by their "family" code
+	GK_DEFAULT_LGS_PROFILE_PATH = ""  # unsupported, main() exits
+
+# inverse mapping of GK_DEV_DATA_MAP, to index device types by their "family" code
 GK_DEV_FAMILY_MAP = {
 	'kb'    : "Keyboard",
 	'lhc'   : "LeftHandedController",
@@ -116,32 +116,44 @@ class GKSettings:
 	currShiftState: dict = field(default_factory=dict)
 	autoSwitchProfiles: bool = True
 	profilePollInterval: float = 1.0
+	adaptivePolling: bool = True
+	watcherStatsInterval: float = 0.0   # seconds between logging file watcher statistics, 0 to disable
 	startedByTP: bool = False
 	useLGSDI: bool = False
 	reportBtnStates: bool = False
 	ignoreNextSettingsChange: bool = False
-	profiles: dict = field(default_factory=dict)
+	displayedProfile: object = None   # GameProfile whose data was last sent to TP
+	parserWorkers: int = 0   # processes used for loading all profiles, 0 = number of CPUs, 1 = no pool
+	cacheFile: str = os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])), "lgkeys.cache")
+	memProfiles: int = 8        # maximum number of fully parsed profiles to keep in memory
+	memBudgetMB: float = 32.0   # approximate memory budget for fully parsed profiles
+	snapshotFile: str = os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])), "lgkeys.states.json")
+	profiles: ProfileRegistry = field(default_factory=ProfileRegistry)   # profile headers only, see getFullProfile()
 
 
 # These are all our globals.
-# TODO: protect g_settings with mutex?
-
-try:
-	TPClient = Client(
-		pluginId = GK_PLUGIN_ID,
-		sleepPeriod = 0.05,
-		autoClose = True,
-		checkPluginId = True,
-		maxWorkers = 6
-	)
-except Exception as e:
-	sys.exit(f"Could not create TP Client, exiting. Error was:\n{repr(e)}")
+# Once running, g_settings and the profile data are only accessed from the g_commands thread. TP Client
+# handlers, the file watcher, timers and LGSDI callbacks post their work to it instead of running it directly.
+# TPClient and g_commands are only created in main(), since the profile parser's pool worker processes
+# import this module too and shouldn't set up any of that.
 
+TPClient = None    # TouchPortalAPI.Client, see createClient()
 g_settings = GKSettings()
 g_log = Logger(getLogger())
 g_parser = GameProfileParser()
-g_observer = None  # WatcherThread
+g_profile_lru = ProfileLRU()  # fully parsed profiles
+g_observer = None  # WatcherService
+g_retry_timer = None  # Timer for retrying profiles which failed to load
+g_failed_count = 0    # number of unparseable profiles last reported
 g_lgsdi = None     # LGSDInterface
+g_commands = None  # CommandQueue which serializes all state changes, see above
+g_file_changes = ChangeSet()  # profile file changes waiting to be processed by g_commands
+g_file_changes_lock = Lock()
+g_reload_generation = 0  # incremented by every full reload request, see reloadAllProfiles()
+g_reload_lock = Lock()
+g_snapshot = None        # StateSnapshot of the states last sent to TP
+g_snapshot_timer = None  # Timer for saving the snapshot some time after a change
+GK_SNAPSHOT_SAVE_DELAY = 10.0  # seconds
 
 ## Utilities
 
@@ -151,24 +163,28 @@ def profilesPath():
 def getProfileById(guid):
 	return g_settings.profiles.get(guid)
 
+# Returns the fully parsed version of a profile (with all the macros and assignments), loading it if necessary.
+def getFullProfile(guid):
+	if not (header := getProfileById(guid)):
+		return None
+	if (prof := g_profile_lru.get(header.guid)):
+		return prof
+	# the file name doesn't have to match the guid in the XML, so use the path the header was read from
+	path = header.path or os.path.join(profilesPath(), guid + ".xml")
+	if (prof := g_parser.parse_profile(path, devices=g_settings.useDeviceTypes)):
+		prof.lpd = max(prof.lpd, header.lpd)
+		g_profile_lru.put(prof)
+		g_log.dbg(f"Loaded full profile '{prof.name}'; in memory: {g_profile_lru.stats()}")
+	return prof
+
 def currentProfile():
-	return getProfileById(g_settings.currProfileId)
+	return getFullProfile(g_settings.currProfileId)
 
 def getProfileByName(name):
-	for _, prof in g_settings.profiles.items():
-		if prof.name == name:
-			return prof
-	return None
+	return g_settings.profiles.byName(name)
 
 def getLastUsedProfile():
-	ret = None
-	newest = datetime(1970, 1, 1)
-	for _, prof in g_settings.profiles.items():
-		if prof.lpd > newest:
-			newest = prof.lpd
-			ret = prof
-	# g_log.dbg(f"Last used profile: {ret.name} on {newest}")
-	return ret
+	return g_settings.profiles.lastPlayed()
 
 def profileIdFromPath(path):
 	try:
@@ -191,6 +207,24 @@ def stateIdForStateMacroName(dev_code, key_pfx, key, state):
 def stateIdForButtonPressState(dev_code, key_pfx, key):
 	return stateIdForCurrentMacroName(dev_code, key_pfx, key) + ".pressed"
 
+@lru_cache(maxsize=None)
+def keyStateIdsForDevice(devtype):
+	"""
+	Returns a tuple with one entry per key of the device type, each entry being:
+	(current slot state ID, description, ((M1 slot state ID, description), (M2 ...), ...))
+	The per-slot tuple is empty for devices with only one memory slot.
+	"""
+	max_keys, max_sts, key_pfx, dev_code = getDataMapForDevice(devtype)
+	ret = []
+	for key in range(1, max_keys+1):
+		currkeyname = key_pfx + str(key)
+		if max_sts > 1: currkeyname += " (current M slot)"
+		slots = ()
+		if max_sts > 1:
+			slots = tuple((stateIdForStateMacroName(dev_code, key_pfx, key, state), f"{devtype} {key_pfx}{key}M{state}") for state in range(1, max_sts+1))
+		ret.append((stateIdForCurrentMacroName(dev_code, key_pfx, key), devtype+" "+currkeyname, slots))
+	return tuple(ret)
+
 def boolFromName(name:str):
 	return name.lower() not in ("0","false","disable","disabled","no","n")
 
@@ -205,7 +239,8 @@ def startObserver():
 	if g_observer and g_observer.is_alive():
 		return
 	g_log.dbg("Starting Observer")
-	g_observer = WatcherThread(profilesPath(), onProfilesChanged, g_settings.profilePollInterval)
+	g_observer = WatcherService(g_settings.profilePollInterval, adaptive=g_settings.adaptivePolling, stats_interval=g_settings.watcherStatsInterval)
+	g_observer.watch("profiles", profilesPath(), onProfilesChanged)
 	g_observer.start()
 
 def stopObserver():
@@ -216,13 +251,62 @@ def stopObserver():
 	g_observer.join(5)
 	g_observer = None
 
-# called by observer thread using Timer
-def onProfilesChanged(added, modified, deleted):
+# Applies changed watcher settings to the running observer, if any, without restarting it.
+def updateObserver():
+	if g_settings.profilePollInterval <= 0.0:
+		stopObserver()
+	elif not g_observer:
+		startObserver()
+	else:
+		g_observer.set_interval(g_settings.profilePollInterval, g_settings.adaptivePolling)
+		g_observer.watch("profiles", profilesPath(), onProfilesChanged)
+
+# Let the observer know that profile changes are more likely soon, eg. after some user action.
+def pokeObserver():
+	if g_observer:
+		g_observer.poke()
+
+# called by the observer dispatcher thread, one batch of changes at a time. Batches which arrive while an
+# earlier one is still waiting to be processed are merged into it.
+def onProfilesChanged(added, modified, deleted, stats=None):
+	with g_file_changes_lock:
+		g_file_changes.add(added, modified, deleted, stats)
+	g_commands.post(processProfileChanges, key="profileChanges")
+
+def processProfileChanges():
+	with g_file_changes_lock:
+		added, modified, deleted, stats = g_file_changes.take()
 	modified.extend(added)
-	if modified: onProfilesModified(modified)
+	if modified: onProfilesModified(modified, stats)
 	if deleted: onProfilesDeleted(deleted)
-
-def onProfilesModified(paths):
+	handleParseFailures()
+
+# Schedules a retry of any profiles which failed to load but may just have been caught in the middle of a write,
+# and reports the total number of unparseable profiles if it has changed.
+def handleParseFailures():
+	global g_retry_timer, g_failed_count
+	# a retry which is already queued calls this again when it's done
+	if not g_commands.isPending("retryFailed") and (delay := g_parser.quarantine.nextRetryDelay()) is not None:
+		if g_retry_timer:
+			g_retry_timer.cancel()
+		g_retry_timer = Timer(delay, g_commands.post, (retryFailedProfiles,), {'key': "retryFailed"})
+		g_retry_timer.daemon = True
+		g_retry_timer.start()
+	if (count := len(g_parser.quarantine)) != g_failed_count:
+		g_failed_count = count
+		if count:
+			g_log.warn(f"{count} profile file(s) could not be loaded.")
+			sendMessage(f"{count} profile(s) could not be loaded, check the log for details.")
+
+def retryFailedProfiles():
+	if (paths := g_parser.quarantine.dueRetries()):
+		g_log.dbg(f"Retrying failed profiles: {paths}")
+		onProfilesModified(paths, force=True)
+	handleParseFailures()
+
+# stats is an optional dict of { 'path' : FileStat } from the observer, to avoid stat'ing the files again.
+# With force the files are always parsed, skipping the quick checks for unchanged contents.
+def onProfilesModified(paths, stats=None, force=False):
 	global g_settings
 	switch_to = None
 	last_played = datetime(1970, 1, 1)
@@ -232,22 +316,35 @@ def onProfilesModified(paths):
 		if not (prof_id := profileIdFromPath(path)):
 			continue
 		saved_prof = g_settings.profiles.get(prof_id)
-		if saved_prof and saved_prof.fsize == os.stat(path).st_size:
+		st = stats.get(path) if stats else None
+		if saved_prof and not force:
+			st = st or os.stat(path)
 			# if using debug interface for profile switches and size has not changed, assume it's just a profile switch
-			if g_settings.useLGSDI:
+			if g_settings.useLGSDI and saved_prof.fsize == st.st_size:
 				continue
-			# quick check for modified profile by just parsing the "header" meta data
-			if not (new_prof := g_parser.parse_profile(path, header_only=True)):
+			# quick check for modified profile by just reading the "header" meta data
+			if not (new_prof := g_parser.sniff_profile_header(path)):
 				continue
-			# Check if only the "last played date" has changed, w/out file size change, meaning profile was only selected (not edited)
-			if new_prof.lpd > saved_prof.lpd:
-				g_settings.profiles[prof_id].lpd = new_prof.lpd
-				if new_prof.lpd > last_played:
-					switch_to = saved_prof
-					last_played = new_prof.lpd
+			# LGS only rewrites the <profile> tag when a profile is selected, which doesn't change the file size. If the last played
+			# date didn't change either then hash the rest of the file to tell a re-save from an edit, if we have a hash to compare to.
+			unchanged = new_prof.name == saved_prof.name and new_prof.fsize == saved_prof.fsize
+			if unchanged and new_prof.lpd == saved_prof.lpd:
+				if saved_prof.chash and (hashed := g_parser.sniff_profile_header(path, with_hash=True)):
+					new_prof = hashed
+				unchanged = bool(new_prof.chash) and new_prof.chash == saved_prof.chash
+			if unchanged:
+				g_log.dbg(f"Profile '{saved_prof.name}' contents unchanged, skipping reload.")
+				saved_prof.fsize = st.st_size
+				if g_parser.cache:
+					g_parser.cache.refresh(path, st, new_prof)
+				if new_prof.lpd > saved_prof.lpd:
+					g_settings.profiles.setLastPlayed(prof_id, new_prof.lpd)
+					if new_prof.lpd > last_played:
+						switch_to = saved_prof
+						last_played = new_prof.lpd
 				continue
 		# new or modified profile, parse the whole file
-		if (new_prof := reloadProfile(prof_id)):
+		if (new_prof := reloadProfile(prof_id, st, force)):
 			if new_prof.lpd > last_played:
 				switch_to = new_prof
 				last_played = new_prof.lpd
@@ -256,13 +353,18 @@ def onProfilesModified(paths):
 		g_settings.lastPlayedProfId = switch_to.guid
 		if g_settings.autoSwitchProfiles:
 			setCurrentProfile(switch_to)
+		else:
+			getFullProfile(switch_to.guid)  # prefetch
 
 def onProfilesDeleted(paths):
 	global g_settings
 	for path in paths:
-		if (prof_id := profileIdFromPath(path)):
-			del g_settings.profiles[prof_id]
-			if prof_id == g_settings.currProfileId:
+		if g_parser.cache:
+			g_parser.cache.remove(path)
+		g_parser.quarantine.remove(path)
+		if (prof_id := profileIdFromPath(path)) and (prof := g_settings.profiles.pop(prof_id)):
+			g_profile_lru.remove(prof.guid)
+			if prof.guid == g_settings.currProfileId:
 				setCurrentProfile(getProfileByName("Default Profile"))
 	updateAvailableProfilesChoice()
 
@@ -306,9 +408,8 @@ def lgsdiSetFilter():
 	g_lgsdi.set_filter(filt)
 
 
-# called directly by LGSDInterface
+# called directly by LGSDInterface, from its own thread
 def onLgsdiMessage(msg):
-	global g_settings
 	g_log.dbg(f"Get message from LGSDI: {msg}")
 	parts = msg.split(".")
 	if len(parts) < 3:
@@ -318,26 +419,32 @@ def onLgsdiMessage(msg):
 	dev = str(parts[1])
 	arg = ".".join(parts[2:])
 	if act == "PROFILE_ACTIVATED":
-		prof = None
-		if arg.startswith("{"):
-			prof = getProfileById(arg)
-		else:
-			prof = getProfileByName(arg)
-		if not prof:
-			g_log.warn(f"Could not find profile for name/id: {arg}")
-			return
-		g_settings.profiles[prof.guid].lpd = datetime.now()
-		g_settings.lastPlayedProfId = prof.guid
-		if g_settings.autoSwitchProfiles:
-			setCurrentProfile(prof)
+		pokeObserver()
+		g_commands.post(onLgsdiProfileActivated, arg, key="lgsdiProfile")
 	elif act == "M_PRESSED":
-		setCurrentShiftState(dev, int(arg))
+		g_commands.post(setCurrentShiftState, dev, int(arg), key=("shiftState", dev))
 	elif g_settings.reportBtnStates:
+		# button states don't touch any of our data, so they're sent right away
 		# this assumes we're already filtering out "M_RELEASED" events
 		state = act.endswith("_PRESSED")
 		if state or act.endswith("_RELEASED"):
 			if (key_pfx := getDataMapForDevice(GK_DEV_FAMILY_MAP.get(dev))[2]):
-				TPClient.stateUpdate(stateIdForButtonPressState(dev, key_pfx, int(arg)), str(int(state)))
+				TPClient.stateUpdate(stateIdForButtonPressState(dev, key_pfx, int(arg)), str(int(state)), TPPRIORITY.interactive)
+
+def onLgsdiProfileActivated(arg):
+	global g_settings
+	prof = None
+	if arg.startswith("{"):
+		prof = getProfileById(arg)
+	else:
+		prof = getProfileByName(arg)
+	if not prof:
+		g_log.warn(f"Could not find profile for name/id: {arg}")
+		return
+	g_settings.profiles.setLastPlayed(prof.guid, datetime.now())
+	g_settings.lastPlayedProfId = prof.guid
+	if g_settings.autoSwitchProfiles:
+		setCurrentProfile(prof)
 
 
 ## TP interaction handlers, mostly called by TPClient (directly or indirectly)
@@ -351,26 +458,56 @@ def setCurrentProfile(profile):
 		return
 	g_settings.currProfileId = profile.guid
 	g_settings.currProfileName = profile.name
-	updateStatesForProfile(profile)
+	updateStatesForProfile(getFullProfile(profile.guid))
 	g_settings.ignoreNextSettingsChange = True
 	TPClient.settingUpdate(GK_SET_LAST_PROF, profile.guid)
 	sendMessage("Profile activated: " + profile.name)
 
+def setCurrentProfileByName(name):
+	setCurrentProfile(getProfileByName(name))
+
 def setCurrentShiftState(device, state, force=False):
 	global g_settings
 	if g_settings.currShiftState.get(device) == state and not force:
 		return
 	g_settings.currShiftState[device] = state
 	state_name = GK_STATE_ROOT + device + GK_STATE_KBD_MEM_SLOT_SFX
-	TPClient.stateUpdate(state_name, str(state))
-	updateKeyStates(currentProfile(), True)
+	TPClient.stateUpdate(state_name, str(state), TPPRIORITY.interactive)
+	updateKeyStates(currentProfile(), True)  # also marks the snapshot as changed
 
-def updateStatesForProfile(profile):
+def updateStatesForProfile(profile, force=False):
+	global g_settings
 	if not profile:
 		return
-	TPClient.stateUpdate(GK_STATE_PROF_NAME, profile.name)
-	updateKeyStates(profile, False)
-	updateMemorySlotNameStates(profile)
+	if (displayed := g_settings.displayedProfile) and not force:
+		updateChangedStates(displayed, profile)
+	else:
+		TPClient.stateUpdate(GK_STATE_PROF_NAME, profile.name, TPPRIORITY.interactive)
+		updateKeyStates(profile, False)
+		updateMemorySlotNameStates(profile)
+	g_settings.displayedProfile = profile
+	markSnapshotDirty()
+
+# Sends only the states which differ between the currently displayed profile and new_prof.
+def updateChangedStates(old_prof, new_prof):
+	diff = old_prof.diff(new_prof, normalizedDeviceTypes())
+	if not diff:
+		return
+	g_log.dbg(f"Changes from '{old_prof.name}' to '{new_prof.name}': {diff.describe()}")
+	if diff.name_changed:
+		TPClient.stateUpdate(GK_STATE_PROF_NAME, new_prof.name, TPPRIORITY.interactive)
+	states = []
+	for devtype, key, state, _, name in diff.keys:
+		_, max_sts, _, dev_code = getDataMapForDevice(devtype)
+		curr_id, _, slot_ids = keyStateIdsForDevice(devtype)[key-1]
+		value = name or g_settings.unmappedButtonText
+		if max_sts == 1 or state == g_settings.currShiftState.get(dev_code, 1):
+			states.append({"id": curr_id, "value": value})
+		if slot_ids:
+			states.append({"id": slot_ids[state-1][0], "value": value})
+	for dev_code, slot, _, name in diff.state_names:
+		states.append({"id": GK_STATE_ROOT + dev_code + "." + slot + ".name", "value": name})
+	TPClient.stateUpdateMany(states, TPPRIORITY.bulk)
 
 def updateAutoswitchState(state = True):
 	text = boolToName(state)  # ("Disabled", "Enabled")[int(state)]
@@ -378,14 +515,15 @@ def updateAutoswitchState(state = True):
 	sendMessage("Automatic profile switching " + text)
 
 def updateAvailableProfilesChoice():
-	names = []
-	for (_, prof) in g_settings.profiles.items():
-		names.append(prof.name)
-	names.sort()
-	TPClient.choiceUpdate(GK_ACT_SWITCH_PROF_DATA, names)
+	TPClient.choiceUpdate(GK_ACT_SWITCH_PROF_DATA, g_settings.profiles.names(), TPPRIORITY.bulk)
+	markSnapshotDirty()
 	# TPClient.choiceUpdate(GK_EVT_PROF_CHANGE, names)  # can't update event valueChoices in TP :(
 
 def updateMemorySlotNameStates(profile):
+	if (states := memorySlotNameStates(profile)):
+		TPClient.stateUpdateMany(states, TPPRIORITY.bulk)
+
+def memorySlotNameStates(profile):
 	states = []
 	for dev in GK_DEV_DATA_MAP.values():
 		_, max_sts, _, dev_code = dev
@@ -394,37 +532,35 @@ def updateMemorySlotNameStates(profile):
 		sname = GK_STATE_ROOT + dev_code + "."
 		for slot, name in profile.getStateNames(dev_code, max_sts).items():
 			states.append({"id": sname + slot + ".name", "value": name})
-	if len(states):
-		TPClient.stateUpdateMany(states)
+	return states
 
 def updateKeyStates(profile, state_only=False):
 	if not profile:
 		return
+	if (states := keyStatesForProfile(profile, state_only)):
+		TPClient.createStateMany(states, TPPRIORITY.bulk)
+	markSnapshotDirty()
+
+# Returns a list of key macro name states for the profile, as used by createStateMany(). With state_only only
+# the states showing the current memory slot's names are included.
+def keyStatesForProfile(profile, state_only=False):
 	states = []
+	unmapped = g_settings.unmappedButtonText
 	for devtype in normalizedDeviceTypes():
-		max_keys, max_sts, key_pfx, dev_code = getDataMapForDevice(devtype)
-		curr_state = g_settings.currShiftState.get(dev_code, 1)
-		# print(devtype, st_name, max_keys)
-		for key in range(1, max_keys+1):
-			for state in range(1, max_sts+1):
-				keyname = f"{key_pfx:s}{key:d}M{state:d}"
-				value = g_settings.unmappedButtonText
-				if (macro := profile.getMacroForDeviceKey(devtype, keyname)):
-					value = macro.name
-				if state == curr_state or max_sts == 1:
-					sname = stateIdForCurrentMacroName(dev_code, key_pfx, key)
-					currkeyname = key_pfx + str(key)
-					if max_sts > 1: currkeyname += " (current M slot)"
-					states.append({"id": sname, 'desc': devtype+" "+currkeyname, "value": value})
-					# print(sname, currkeyname, value)
-				if not state_only and max_sts > 1:
-					sname = stateIdForStateMacroName(dev_code, key_pfx, key, state)
-					states.append({"id": sname, 'desc': devtype+" "+keyname, "value": value})
+		_, max_sts, _, dev_code = getDataMapForDevice(devtype)
+		curr_idx = g_settings.currShiftState.get(dev_code, 1) - 1 if max_sts > 1 else 0
+		table = profile.getKeyTable(devtype)
+		for key, (curr_id, curr_desc, slot_ids) in enumerate(keyStateIdsForDevice(devtype)):
+			names = table[key] if table else ()
+			if curr_idx < max_sts:
+				states.append({"id": curr_id, 'desc': curr_desc, "value": (names and names[curr_idx]) or unmapped})
+			if not state_only:
+				for state, (sname, sdesc) in enumerate(slot_ids):
+					states.append({"id": sname, 'desc': sdesc, "value": (names and names[state]) or unmapped})
 		# default shift state for this device
 		if not g_settings.currShiftState.get(dev_code):
 			g_settings.currShiftState[dev_code] = 1
-	if states:
-		TPClient.createStateMany(states)
+	return states
 
 def removeDynamicDeviceStates():
 	states = []
@@ -436,6 +572,7 @@ def removeDynamicDeviceStates():
 				states.append(stateIdForStateMacroName(dev_code, key_pfx, key, state))
 	if states:
 		TPClient.removeStateMany(states)
+	g_settings.displayedProfile = None
 
 def addDynamicPressStates():
 	states = []
@@ -459,59 +596,119 @@ def removeDynamicPressStates():
 	if states:
 		TPClient.removeStateMany(states)
 
-def reloadProfile(prof_id):
+def reloadProfile(prof_id, st=None, force=False):
 	global g_settings
 	path = os.path.join(profilesPath(), prof_id + ".xml")
-	if not os.path.isfile(path):
+	if st is None and not os.path.isfile(path):
 		g_log.warn(f"Profile file not found at: {path}")
 		return None
-	if (new_prof := g_parser.parse_profile(path, devices=g_settings.useDeviceTypes)):
-		g_settings.profiles[prof_id] = new_prof
+	if (new_prof := g_parser.parse_profile(path, devices=g_settings.useDeviceTypes, st=st, force=force)):
+		# keyed on the guid from the XML, which may not match the file name exactly
+		g_settings.profiles.add(new_prof.header())
+		g_profile_lru.put(new_prof)
 		updateAvailableProfilesChoice()
-		if prof_id == g_settings.currProfileId:
+		if new_prof.guid == g_settings.currProfileId:
 			updateStatesForProfile(new_prof)
 		return new_prof
 	return None
 
-def reloadAllProfiles():
+# Starts a new full reload "generation", which makes any full reload still in progress stop and discard its results.
+def supersedeReloads():
+	global g_reload_generation
+	with g_reload_lock:
+		g_reload_generation += 1
+		return g_reload_generation
+
+# May be called from any thread.
+def requestReloadAll(notify=False):
+	g_commands.post(reloadAllProfiles, supersedeReloads(), notify, key="reloadAll")
+
+def reloadCurrentProfile():
+	if g_settings.currProfileId:
+		reloadProfile(g_settings.currProfileId)
+		sendMessage(f"Reloaded profile {g_settings.currProfileName}.")
+
+# `gen` is the reload generation this was requested with, or None to start a new one.
+def reloadAllProfiles(gen=None, notify=False):
 	global g_settings
-	if not g_settings.profDir:
+	if gen is None:
+		gen = supersedeReloads()
+	if not g_settings.profDir or gen != g_reload_generation:
+		return
+	# a full reload makes any pending single profile reload redundant
+	g_commands.cancel("reloadCurrent")
+	profiles = g_parser.parse_profiles(profilesPath(), g_settings.useDeviceTypes, g_settings.parserWorkers, header_only=True,
+	                                   cancel=lambda: gen != g_reload_generation)
+	if profiles is None or gen != g_reload_generation:
+		g_log.dbg("Profiles reload was superseded by a newer one.")
 		return
-	g_settings.profiles = g_parser.parse_profiles(profilesPath(), g_settings.useDeviceTypes)
+	g_settings.profiles = ProfileRegistry(profiles)
+	g_profile_lru.clear()
 	# print(g_settings.profiles)
 	updateAvailableProfilesChoice()
 	updateStatesForProfile(currentProfile())
+	handleParseFailures()
+	if notify:
+		sendMessage("All profiles reloaded.")
+
+# Returns the device types from the list which we know about.
+def parseDeviceTypes(devtypes, warn=False):
+	ret = []
+	for devtype in devtypes:
+		if GK_DEV_DATA_MAP.get(devtype.split(".")[0]):
+			ret.append(devtype)
+		elif warn:
+			g_log.warn(f"Could not find data map for device type: {devtype}")
+	return ret
+
+# The settings array can just be flattened to a single dict
+def settingsToDict(val_arry):
+	return {list(val_arry[i])[0]:list(val_arry[i].values())[0] for i in range(len(val_arry))}
 
-def handleSettingsChange(val_arry, on_connect=False):
+# Returns True if applying the settings would reload all profiles. Only reads the current settings so it can be
+# used from the TP client thread, before handleSettingsChange() runs.
+def settingsNeedReload(settings):
+	if (value := settings.get(GK_SET_PROF_DIR)) and value != g_settings.profDir:
+		return True
+	if (value := settings.get(GK_SET_DEVC_CATS)) is not None:
+		value = [x.strip() for x in value.split(',')]
+		return bool(value) and parseDeviceTypes(value) != g_settings.useDeviceTypes
+	return False
+
+# `gen` is the reload generation already started by the caller if the new settings need a full reload, see onSettings().
+def handleSettingsChange(val_arry, on_connect=False, gen=None):
 	global g_settings
 	g_log.dbg(f"Got Settings: {val_arry}")
 	ignore = g_settings.ignoreNextSettingsChange
 	g_settings.ignoreNextSettingsChange = False
 	if ignore or not val_arry:
+		# a reload in progress may have been superseded already, so start it again
+		if gen is not None:
+			reloadAllProfiles(gen)
 		return
-	# the settings array can just be flattened to a single dict
-	settings = {list(val_arry[i])[0]:list(val_arry[i].values())[0] for i in range(len(val_arry))}
-	profile_reload = not len(g_settings.profiles)
+	settings = settingsToDict(val_arry)
+	profile_reload = gen is not None or not len(g_settings.profiles)
+	observer_update = False
 	# profile path
 	if (value := settings.get(GK_SET_PROF_DIR)) is not None:
 		newpath = value if value else g_settings.profDir
-		profile_reload = profile_reload or g_settings.profDir != newpath
+		if g_settings.profDir != newpath:
+			profile_reload = observer_update = True
 		g_settings.profDir = newpath
 		if value != newpath:
 			TPClient.settingUpdate(GK_SET_PROF_DIR, newpath)
+			if gen is not None:
+				reloadAllProfiles(gen)
 			return
 	# device types to use
 	if (value := settings.get(GK_SET_DEVC_CATS)) is not None:
 		value = [x.strip() for x in value.split(',')]
-		if value and value != g_settings.useDeviceTypes:
-			g_settings.useDeviceTypes = []
-			for devtype in value:
-				if GK_DEV_DATA_MAP.get(devtype.split(".")[0]):
-					g_settings.useDeviceTypes.append(devtype)
-				else:
-					g_log.warn(f"Could not find data map for device type: {devtype}")
-			# remove old states, if any
-			removeDynamicDeviceStates()
+		# compare the filtered list, since unknown types are never in useDeviceTypes
+		if value and parseDeviceTypes(value) != g_settings.useDeviceTypes:
+			g_settings.useDeviceTypes = parseDeviceTypes(value, True)
+			# remove old states, if any (on connect the only existing ones are from the restored snapshot)
+			if not on_connect:
+				removeDynamicDeviceStates()
 			profile_reload = True
 	# LGSDI enable/disable
 	if (value := settings.get(GK_SET_USE_LGSDI)) is not None:
@@ -534,9 +731,13 @@ def handleSettingsChange(val_arry, on_connect=False):
 		value = max(0.0, float(int(value) / 1000))
 		if value != g_settings.profilePollInterval:
 			g_settings.profilePollInterval = value
-			stopObserver()
-			if value > 0.0:
-				startObserver()
+			observer_update = True
+	# adaptive polling rate
+	if (value := settings.get(GK_SET_ADAPTIVE_POLL)) is not None:
+		value = boolFromName(value)
+		if value != g_settings.adaptivePolling:
+			g_settings.adaptivePolling = value
+			observer_update = True
 	# auto-switching of profiles
 	if (value := settings.get(GK_SET_AUTO_SWTCH)) is not None:
 		value = boolFromName(value)
@@ -549,29 +750,102 @@ def handleSettingsChange(val_arry, on_connect=False):
 	if (value := settings.get(GK_SET_UNMAPPED_SLOT)) is not None:
 		if value != g_settings.unmappedButtonText:
 			g_settings.unmappedButtonText = value
-			if not profile_reload:
+			if profile_reload:
+				g_settings.displayedProfile = None  # so the reload sends all the key states, not just the changed ones
+			else:
 				updateKeyStates(currentProfile())
 	# set current profile ID, should only happen at initial connection
 	if on_connect and (value := settings.get(GK_SET_LAST_PROF)):
 		g_settings.currProfileId = value
 
 	if profile_reload:
-		reloadAllProfiles()
+		reloadAllProfiles(gen)  # with no gen this starts a new reload generation
+	if observer_update:
+		updateObserver()
+
+
+## State snapshot for quick startup
+
+# Schedules a snapshot save, if one isn't scheduled already.
+def markSnapshotDirty():
+	global g_snapshot_timer
+	if not g_snapshot:
+		return
+	g_snapshot.dirty = True
+	if not g_snapshot_timer or not g_snapshot_timer.is_alive():
+		g_snapshot_timer = Timer(GK_SNAPSHOT_SAVE_DELAY, g_commands.post, (saveStateSnapshot,), {'key': "saveSnapshot"})
+		g_snapshot_timer.daemon = True
+		g_snapshot_timer.start()
+
+def saveStateSnapshot():
+	if not g_snapshot or not g_snapshot.dirty or not (profile := g_settings.displayedProfile):
+		return
+	g_snapshot.save({
+		'deviceTypes': g_settings.useDeviceTypes,
+		'profileId': profile.guid,
+		'profileName': profile.name,
+		'shiftStates': g_settings.currShiftState,
+		'profiles': g_settings.profiles.names(),
+		'keyStates': keyStatesForProfile(profile),
+		'slotNames': memorySlotNameStates(profile),
+	})
+
+# Sends the states saved in the last snapshot, if it matches the device types in the settings array.
+# Once the profiles are loaded the normal state updates correct anything which has changed since then
+# (and the TP Client skips sending any values which are already current).
+def restoreStateSnapshot(val_arry):
+	if not g_snapshot or not (snap := g_snapshot.load()):
+		return
+	settings = {k: v for s in val_arry for k, v in s.items()}
+	if (value := settings.get(GK_SET_DEVC_CATS)) is None or parseDeviceTypes([x.strip() for x in value.split(',')]) != snap.get('deviceTypes'):
+		g_log.dbg("Device types changed since the state snapshot was saved, not restoring it.")
+		return
+	try:
+		g_settings.currShiftState.update({dev: int(state) for dev, state in snap['shiftStates'].items()})
+		TPClient.stateUpdate(GK_STATE_PROF_NAME, snap['profileName'], TPPRIORITY.interactive)
+		for dev, state in g_settings.currShiftState.items():
+			TPClient.stateUpdate(GK_STATE_ROOT + dev + GK_STATE_KBD_MEM_SLOT_SFX, str(state), TPPRIORITY.interactive)
+		TPClient.createStateMany(snap['keyStates'], TPPRIORITY.bulk)
+		TPClient.stateUpdateMany(snap['slotNames'], TPPRIORITY.bulk)
+		TPClient.choiceUpdate(GK_ACT_SWITCH_PROF_DATA, snap['profiles'], TPPRIORITY.bulk)
+		g_log.info(f"Restored states for profile '{snap['profileName']}' from snapshot.")
+	except Exception as e:
+		g_log.warn(f"Could not restore state snapshot. Error: {repr(e)}")
 
 
 ## TP Client event handler callbacks
+# These run in the TP Client's worker threads and just post the actual work to g_commands.
+
+def createClient():
+	global TPClient
+	TPClient = Client(
+		pluginId = GK_PLUGIN_ID,
+		autoClose = True,
+		checkPluginId = True,
+		maxWorkers = 6,
+		coalesceStates = True
+	)
+	TPClient.on(TPTYPES.onConnect, onConnect)
+	TPClient.on(TPTYPES.onAction, onActions)
+	TPClient.on(TPTYPES.onSettingUpdate, onSettings)
+	TPClient.on(TPTYPES.onBroadcast, onBroadcast)
+	TPClient.on(TPTYPES.onShutdown, onShutdown)
+	TPClient.on(TPTYPES.onError, onError)
 
 # Initial connection handler
-@TPClient.on(TPTYPES.onConnect)
 def onConnect(data):
+	g_commands.post(handleConnect, data)
+
+def handleConnect(data):
 	global g_settings
 	vstr = f"{data.get('pluginVersion', 0) * 0.01:.02f}"
 	g_log.info(f"Connected to TP v{data.get('tpVersionString', '?')}, plugin v{vstr}.")
 	# g_log.dbg(f"Connection: {g_log.format_json(data)}")
 	if settings := data.get('settings'):
+		restoreStateSnapshot(settings)
 		handleSettingsChange(settings, True)
 	if g_settings.profiles:
-		load_prof = getLastUsedProfile() or getProfileByName("Default Profile") or g_settings.profiles.values()[0]
+		load_prof = getLastUsedProfile() or getProfileByName("Default Profile") or next(iter(g_settings.profiles.values()))
 		g_settings.lastPlayedProfId = load_prof.guid
 		if g_settings.autoSwitchProfiles:
 			setCurrentProfile(load_prof)
@@ -583,54 +857,54 @@ def onConnect(data):
 	sendMessage(f"Connected to {GK_PLUGIN_NAME} v{__version__}")
 
 # Action handler
-@TPClient.on(TPTYPES.onAction)
+# Actions which make an earlier one still waiting in the queue redundant (eg. two profile switches) use the same command key.
 def onActions(data):
 	g_log.dbg(f"Action: {repr(data)}")
 	if not (action_data := data.get('data')) or not (aid := data.get('actionId')):
 		return
+	pokeObserver()
 	if aid == GK_ACT_MEM_TOGGLE:
 		slot_num = TPClient.getActionDataValue(action_data, GK_ACT_MEM_TOGGLE_SLT)
 		dev_id = TPClient.getActionDataValue(action_data, GK_ACT_MEM_TOGGLE_DEV)
 		if slot_num and dev_id:
 			if (dev_id := getDataMapForDevice(dev_id)[3]):
-				setCurrentShiftState(str(dev_id), int(slot_num))
+				g_commands.post(setCurrentShiftState, str(dev_id), int(slot_num), key=("shiftState", str(dev_id)))
 	elif aid == GK_ACT_SWITCH_PROF:
 		if (pname := TPClient.getActionDataValue(action_data, GK_ACT_SWITCH_PROF_DATA)):
-			setCurrentProfile(getProfileByName(pname))
+			g_commands.post(setCurrentProfileByName, pname, key="switchProfile")
 	elif aid == GK_ACT_AUTOSW_TOGGLE:
-		# the actual toggle happens in handleSettingsChange()
-		TPClient.settingUpdate(GK_SET_AUTO_SWTCH, boolToName(not g_settings.autoSwitchProfiles))
-	elif aid == GK_ACT_RELOAD_CURR and g_settings.currProfileId:
-		reloadProfile(g_settings.currProfileId)
-		sendMessage(f"Reloaded profile {g_settings.currProfileName}.")
+		g_commands.post(toggleAutoSwitch)
+	elif aid == GK_ACT_RELOAD_CURR:
+		g_commands.post(reloadCurrentProfile, key="reloadCurrent")
 	elif aid == GK_ACT_RELOAD_ALL:
-		reloadAllProfiles()
-		sendMessage("All profiles reloaded.")
+		requestReloadAll(True)
 	else:
 		g_log.warn("Got unknown action ID: " + aid)
 
+def toggleAutoSwitch():
+	# the actual toggle happens in handleSettingsChange()
+	TPClient.settingUpdate(GK_SET_AUTO_SWTCH, boolToName(not g_settings.autoSwitchProfiles))
+
 # Settings handler
-@TPClient.on(TPTYPES.onSettingUpdate)
 def onSettings(data):
 	# g_log.dbg(f"Settings: {g_log.format_json(data)}")
 	if (settings := data.get('values')):
-		handleSettingsChange(settings)
+		# stop any reload in progress right away if it's going to be redone with the new settings anyway
+		gen = supersedeReloads() if settingsNeedReload(settingsToDict(settings)) else None
+		g_commands.post(handleSettingsChange, settings, gen=gen)
 
 # Page change handler
-@TPClient.on(TPTYPES.onBroadcast)
 def onBroadcast(data):
 	# g_log.dbg(f"Broadcast: {g_log.format_json(data)}")
 	if data.get('event', "") == "pageChange":
-		setCurrentProfile(getProfileByName(data.get("pageName", "")))
+		g_commands.post(setCurrentProfileByName, data.get("pageName", ""), key="switchProfile")
 
 # Shutdown handler
-@TPClient.on(TPTYPES.onShutdown)
 def onShutdown(data):
 	g_log.info('Received shutdown event from TP Client.')
 	# TPClient.disconnect()
 
 # Error handler
-@TPClient.on(TPTYPES.onError)
 def onError(exc):
 	g_log.err(f'Error in TP Client event handler: {repr(exc)}')
 	# ... do something ?
@@ -654,9 +928,17 @@ def onError(exc):
 ## main
 
 def main():
-	global g_settings, TPClient
+	global g_settings, TPClient, g_snapshot, g_commands
 	ret = 0
 
+	if not GK_DEFAULT_LGS_PROFILE_PATH:
+		sys.exit(f"Unsupported/unknown platform: {sys.platform}")
+	try:
+		createClient()
+	except Exception as e:
+		sys.exit(f"Could not create TP Client, exiting. Error was:\n{repr(e)}")
+	g_commands = CommandQueue()
+
 	# handle CLI arguments
 	parser = ArgumentParser()
 	parser.add_argument("-p", metavar="<path>",
@@ -667,6 +949,20 @@ def main():
 	                    help="Only log warnings and errors.")
 	parser.add_argument("-q", action='store_true',
 	                    help="Disable all logging (quiet).")
+	parser.add_argument("-j", metavar="<n>", type=int, default=g_settings.parserWorkers,
+	                    help="Number of processes to use for loading profiles (default is 0 for number of CPUs, 1 to disable).")
+	parser.add_argument("-c", metavar="<cachefile>",
+	                    help=f"Parsed profiles cache file (default is: '{g_settings.cacheFile}')")
+	parser.add_argument("--nocache", action='store_true',
+	                    help="Do not use a parsed profiles cache file.")
+	parser.add_argument("--nosnapshot", action='store_true',
+	                    help="Do not save or restore the last states sent to TouchPortal, for quicker startup.")
+	parser.add_argument("--mem-profiles", metavar="<n>", type=int, default=g_settings.memProfiles,
+	                    help=f"Maximum number of fully loaded profiles to keep in memory (default is {g_settings.memProfiles}).")
+	parser.add_argument("--mem-budget", metavar="<MB>", type=float, default=g_settings.memBudgetMB,
+	                    help=f"Approximate memory budget for fully loaded profiles, in MB (default is {g_settings.memBudgetMB:.0f}).")
+	parser.add_argument("--watch-stats", metavar="<sec>", type=float, default=g_settings.watcherStatsInterval,
+	                    help="Log profile folder watcher statistics at this interval, in seconds (requires -d, default is 0 to disable).")
 	parser.add_argument("-l", metavar="<logfile>",
 	                    help="Log to this file (default is stdout).")
 	parser.add_argument("-s", action='store_true',
@@ -714,6 +1010,23 @@ def main():
 
 	if opts.p:
 		g_settings.profDir = opts.p
+	g_settings.parserWorkers = max(0, opts.j)
+	if opts.nocache:
+		g_settings.cacheFile = ""
+	elif opts.c:
+		g_settings.cacheFile = opts.c
+	if opts.nosnapshot:
+		g_settings.snapshotFile = ""
+	g_settings.memProfiles = max(1, opts.mem_profiles)
+	g_settings.memBudgetMB = max(0.0, opts.mem_budget)
+	g_settings.watcherStatsInterval = max(0.0, opts.watch_stats)
+	g_profile_lru.max_profiles = g_settings.memProfiles
+	g_profile_lru.max_bytes = int(g_settings.memBudgetMB * 1024 * 1024)
+	if g_settings.cacheFile:
+		g_parser.cache = ProfileCache(g_settings.cacheFile, max_full_bytes=g_profile_lru.max_bytes)
+		g_parser.cache.load()
+	if g_settings.snapshotFile:
+		g_snapshot = StateSnapshot(g_settings.snapshotFile)
 
 	# check if started by TouchPortal
 	started_by = ""
@@ -724,6 +1037,7 @@ def main():
 	# ready to go
 	g_log.info(f"Starting {GK_PLUGIN_NAME} v{__version__} on {sys.platform}. {started_by}")
 
+	g_commands.start()
 	try:
 		TPClient.connect()  # blocking
 		g_log.info('TP Client closed.')
@@ -736,8 +1050,17 @@ def main():
 	finally:
 		TPClient.disconnect()  # make sure it's stopped, no-op if already stopped.
 	# TP disconnected, clean up.
+	g_commands.stop(5)
+	if g_retry_timer:
+		g_retry_timer.cancel()
+	if g_snapshot_timer:
+		g_snapshot_timer.cancel()
+	saveStateSnapshot()
 	stopObserver()
 	stopLGSDI()
+	g_parser.close()
+	if g_parser.cache:
+		g_parser.cache.save()
 	del TPClient
 	del g_settings
 
@@ -746,4 +1069,5 @@ def main():
 
 
 if __name__ == "__main__":
+	freeze_support()  # for profile parser process pool in frozen executable
 	sys.exit(main())
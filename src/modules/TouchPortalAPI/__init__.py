@@ -1,9 +1,10 @@
-from socket import (socket, AF_INET, SOCK_STREAM, SHUT_RDWR)
+from socket import (socket, socketpair, AF_INET, SOCK_STREAM, SHUT_RDWR, SOL_SOCKET, SO_SNDBUF)
 import selectors
 from json import (loads as jloads, dumps as jdumps)
 from pyee import ExecutorEventEmitter
 from concurrent.futures import ThreadPoolExecutor
 from threading import Event, Lock
+from collections import ChainMap, deque
 
 class TYPES:
     onHold_up = 'up'
@@ -17,7 +18,180 @@ class TYPES:
     allMessage = 'any'
     onError = 'error'  # from ExecutorEventEmitter, emitted when an event callback raises an exception
 
-class Client(ExecutorEventEmitter):
+class PRIORITY:
+    '''Send priorities for `Client.send()` and the state helpers. Lower values are sent first.'''
+    interactive = 0  # direct feedback to the user, eg. button presses
+    normal = 1
+    bulk = 2         # large batches which may be delayed, eg. lists of names or choices
+
+class ClientBase():
+    '''
+    The TouchPortal message helpers shared by `Client` and `AsyncClient`.
+    Subclasses provide the `send(data, priority)` and `sendMany(messages, priority)` methods and `currentStates` and `currentSettings` dicts.
+    '''
+    def createState(self, stateId:str, description:str, value:str, priority=PRIORITY.normal):
+        if (msg := self.__createStateMessage(stateId, description, value, self.currentStates)):
+            self.send(msg, priority)
+            self.currentStates[stateId] = value
+
+    def createStateMany(self, states:list, priority=PRIORITY.normal):
+        msgs, values = [], {}
+        pending = ChainMap(values, self.currentStates)
+        try:
+            for state in states:
+                if isinstance(state, dict):
+                    if (msg := self.__createStateMessage(state.get('id', ""), state.get('desc', ""), state.get('value', ""), pending)):
+                        msgs.append(msg)
+                        values[msg['id']] = state.get('value', "")
+                else:
+                    raise TypeError(f'createStateMany() requires a list of dicts, got {type(state)} instead.')
+        except:
+            raise TypeError(f'createStateMany() requires an iteratable, got {type(states)} instead.')
+        self.sendMany(msgs, priority)
+        self.currentStates.update(values)
+
+    def removeState(self, stateId:str, validateExists = True, priority=PRIORITY.normal):
+        if stateId and stateId in self.currentStates:
+            self.send({"type": "removeState", "id": stateId}, priority)
+            self.currentStates.pop(stateId)
+        elif validateExists:
+            raise Exception(f"{stateId} Does not exist.")
+
+    def removeStateMany(self, states:list, priority=PRIORITY.normal):
+        try:
+            ids = list(dict.fromkeys(s for s in states if s and s in self.currentStates))
+        except TypeError:
+            raise TypeError(f'removeStateMany() requires an iteratable, got {type(states)} instead.')
+        self.sendMany([{"type": "removeState", "id": stateId} for stateId in ids], priority)
+        for stateId in ids:
+            self.currentStates.pop(stateId)
+
+    def choiceUpdate(self, choiceId:str, values:list, priority=PRIORITY.normal):
+        if choiceId:
+            if isinstance(values, list):
+                self.send({"type": "choiceUpdate", "id": choiceId, "value": values}, priority)
+            else:
+                raise TypeError(f'choiceUpdate() values argument needs to be a list not a {type(values)}')
+
+    def choiceUpdateSpecific(self, stateId:str, values:list, instanceId:str, priority=PRIORITY.normal):
+        if stateId and instanceId:
+            if isinstance(values, list):
+                self.send({"type": "choiceUpdate", "id": stateId, "instanceId": instanceId, "value": values}, priority)
+            else:
+                raise TypeError(f'choiceUpdateSpecific() values argument needs to be a list not a {type(values)}')
+
+    def settingUpdate(self, settingName:str, settingValue):
+        if settingName and settingName not in self.currentSettings or self.currentSettings[settingName] != settingValue:
+            self.send({"type": "settingUpdate", "name": settingName, "value": settingValue})
+            self.currentSettings[settingName] = settingValue
+
+    def stateUpdate(self, stateId:str, stateValue:str, priority=PRIORITY.normal):
+        if (msg := self.__stateUpdateMessage(stateId, stateValue, self.currentStates)):
+            self.send(msg, priority)
+            self.currentStates[stateId] = stateValue
+
+    def stateUpdateMany(self, states:list, priority=PRIORITY.normal):
+        msgs, values = [], {}
+        pending = ChainMap(values, self.currentStates)
+        try:
+            for state in states:
+                if isinstance(state, dict):
+                    if (msg := self.__stateUpdateMessage(state.get('id', ""), state.get('value', ""), pending)):
+                        msgs.append(msg)
+                        values[msg['id']] = msg['value']
+                else:
+                    raise TypeError(f'StateUpdateMany() requires a list of dicts, got {type(state)} instead.')
+        except TypeError:
+            raise TypeError(f'StateUpdateMany() requires an iteratable, got {type(states)} instead.')
+        self.sendMany(msgs, priority)
+        self.currentStates.update(values)
+
+    # The *Many() methods check new values against `states`, which is a ChainMap of the values
+    # already queued in the same batch over `currentStates`.
+    def __createStateMessage(self, stateId, description, value, states):
+        if stateId and description and value != None:
+            if stateId not in states:
+                return {"type": "createState", "id": stateId, "desc": description, "defaultValue": value}
+            return self.__stateUpdateMessage(stateId, value, states)
+        return None
+
+    @staticmethod
+    def __stateUpdateMessage(stateId, stateValue, states):
+        if stateId and (stateId not in states or states[stateId] != stateValue):
+            return {"type": "stateUpdate", "id": stateId, "value": stateValue}
+        return None
+
+    def updateActionData(self, instanceId:str, stateId:str, minValue, maxValue):
+        '''
+        TouchPortal currently only supports data.type "number"
+        '''
+        self.send({"type": "updateActionData", "instanceId": instanceId, "data": {"minValue": minValue, "maxValue": maxValue, "id": stateId, "type": "number"}})
+
+    @staticmethod
+    def getActionDataValue(data:list, valueId:str=None):
+        '''
+        Utility for processing action messages from TP. For example:
+            {"type": "action", "data": [{ "id": "data object id", "value": "user specified value" }, ...]}
+
+        Returns the `value` with specific `id` from a list of action data,
+        or `None` if the `id` wasn't found. If a null id is passed in `valueId`
+        then the first entry which has a `value` key, if any, will be returned.
+
+        Args:
+            `data`: the "data" array from a TP "action", "on", or "off" message
+            `valueId`: the "id" to look for in `data`. `None` or blank to return the first value found.
+        '''
+        if not data: return None
+        if valueId:
+            return next((x.get('value') for x in data if x.get('id', '') == valueId), None)
+        return next((x.get('value') for x in data if x.get('value') != None), None)
+
+
+class _SendLane():
+    '''Encoded messages of one `PRIORITY` which are waiting to be moved to the `Client` send buffer.'''
+    def __init__(self):
+        self.queue = deque()  # [ [id, data], ... ]
+        self.ids = {}         # { id : number of queued messages with that id, ... }
+        self.updates = {}     # { stateId : queued stateUpdate item, ... } which may still be replaced
+        self.size = 0         # total length of queued data
+
+    def push(self, mid, data, replaceable):
+        if replaceable and (item := self.updates.get(mid)):
+            self.size += len(data) - len(item[1])
+            item[1] = data
+            return
+        item = [mid, data]
+        self.queue.append(item)
+        self.size += len(data)
+        if mid is None:
+            return
+        self.ids[mid] = self.ids.get(mid, 0) + 1
+        if replaceable:
+            self.updates[mid] = item
+        else:
+            # updates queued after this message have to stay after it
+            self.updates.pop(mid, None)
+
+    def pop(self):
+        mid, data = item = self.queue.popleft()
+        self.size -= len(data)
+        if mid is not None:
+            if (n := self.ids[mid] - 1):
+                self.ids[mid] = n
+            else:
+                del self.ids[mid]
+            if self.updates.get(mid) is item:
+                del self.updates[mid]
+        return data
+
+    def clear(self):
+        self.queue.clear()
+        self.ids.clear()
+        self.updates.clear()
+        self.size = 0
+
+
+class Client(ExecutorEventEmitter, ClientBase):
     '''
     A client for TouchPortal plugin integration using event listener callbacks.
     Implements a [pyee.ExecutorEventEmitter](https://pyee.readthedocs.io/en/latest/#pyee.ExecutorEventEmitter).
@@ -25,9 +199,12 @@ class Client(ExecutorEventEmitter):
 
     Args:
         `pluginId`       (str): ID string of the TouchPortal plugin using this client.
-        `sleepPeriod`  (float): Seconds to sleep the event loop between socket read events (default: 0.01).
+        `sleepPeriod`  (float): Deprecated and ignored, the event loop now only wakes up when there is data to read or write.
         `autoClose`     (bool): If `True` then this client will automatically disconnect when a `closePlugin` message is received from TP.
         `checkPluginId` (bool): Validate that `pluginId` matches ours in any messages from TP which contain one (such as actions). Default is `True`.
+        `coalesceStates`(bool): If `True` then a `stateUpdate` for a state which already has an update waiting to be sent replaces
+                               the waiting value instead of being queued after it, so TP only gets the latest value. Updates are never
+                               moved past a `createState` or `removeState` for the same ID. Default is `False`.
         `maxWorkers`     (int): Maximum worker threads to run concurrently for event handlers. Default of `None` creates a default-constructed `ThreadPoolExecutor`.
         `executor`    (object): Passed to `pyee.ExecutorEventEmitter`. By default this is a default-constructed
                                [ThreadPoolExecutor](https://docs.python.org/3/library/concurrent.futures.html#concurrent.futures.ThreadPoolExecutor),
@@ -37,9 +214,10 @@ class Client(ExecutorEventEmitter):
     TPPORT = 12136
     RCV_BUFFER_SZ = 4096   # [B] incoming data buffer size
     SND_BUFFER_SZ = 32**4  # [B] maximum size of send data buffer (1MB)
+    SND_CHUNK_SZ = 2**16   # [B] amount of queued data moved to the socket write buffer at a time, see __fillSendBuffer()
     SOCK_EVENT_TO = 1.0    # [s] timeout for selector.select() event monitor
 
-    def __init__(self, pluginId, sleepPeriod=0.01, autoClose=False, checkPluginId=True, maxWorkers=None, executor=None):
+    def __init__(self, pluginId, sleepPeriod=0.01, autoClose=False, checkPluginId=True, maxWorkers=None, executor=None, coalesceStates=False):
         if not executor and maxWorkers:
             executor = ThreadPoolExecutor(max_workers=maxWorkers)
         super(Client, self).__init__(executor=executor)
@@ -47,6 +225,7 @@ class Client(ExecutorEventEmitter):
         self.sleepPeriod = sleepPeriod
         self.autoClose = autoClose
         self.checkPluginId = checkPluginId
+        self.coalesceStates = coalesceStates
         self.client = None
         self.selector = None
         self.currentStates = {}
@@ -54,10 +233,13 @@ class Client(ExecutorEventEmitter):
         self.__heldActions = {}
         self.__stopEvent = Event()       # main loop interrupt
         self.__stopEvent.set()           # not running yet
-        self.__dataReadyEvent = Event()  # set when __sendBuffer has data
         self.__writeLock = Lock()        # mutex for __sendBuffer
         self.__sendBuffer = bytearray()
+        self.__lanes = [_SendLane() for _ in range(PRIORITY.bulk + 1)]  # messages not yet moved to __sendBuffer, by priority
         self.__recvBuffer = bytearray()
+        self.__wakeRecv = None           # socket pair used by other threads to wake up the event loop, see __wake()
+        self.__wakeSend = None
+        self.__writeWanted = False       # if the socket is currently registered with the selector for EVENT_WRITE
 
     def __buffered_readLine(self):
         try:
@@ -81,8 +263,10 @@ class Client(ExecutorEventEmitter):
         return []
 
     def __write(self):
-        if self.client and self.__sendBuffer and self.__getWriteLock():
+        if self.client and (self.__sendBuffer or self.__hasPending()) and self.__getWriteLock():
             try:
+                if not self.__sendBuffer:
+                    self.__fillSendBuffer()
                 # Should be ready to write
                 sent = self.client.send(self.__sendBuffer)
             except BlockingIOError:
@@ -92,29 +276,47 @@ class Client(ExecutorEventEmitter):
             else:
                 del self.__sendBuffer[:sent]
             finally:
-                if not self.__sendBuffer:
-                    self.__dataReadyEvent.clear()
                 self.__writeLock.release()
 
+    def __wake(self):
+        # Makes selector.select() in the event loop return, eg. when there is new data to send.
+        try:
+            self.__wakeSend.send(b'\0')
+        except (BlockingIOError, AttributeError, OSError):
+            pass  # buffer full means a wakeup is already pending; None/closed socket means we're not running
+
+    def __clearWake(self):
+        try:
+            while self.__wakeRecv.recv(self.RCV_BUFFER_SZ): pass
+        except BlockingIOError:
+            pass
+
+    def __updateWriteInterest(self):
+        # Only ask the selector about the socket being writable while there is something to write,
+        # otherwise select() would return right away nearly every time.
+        if (want := bool(self.__sendBuffer or self.__hasPending())) != self.__writeWanted:
+            self.selector.modify(self.client, selectors.EVENT_READ | (selectors.EVENT_WRITE if want else 0))
+            self.__writeWanted = want
+
     def __run(self):
         try:
             while not self.__stopEvent.is_set():
+                self.__updateWriteInterest()
                 events = self.selector.select(timeout=self.SOCK_EVENT_TO)
-                if self.__stopEvent.is_set():  # may be set while waiting for selector events (unlikely)
+                if self.__stopEvent.is_set():  # may be set while waiting for selector events
                     break
-                for _, mask in events:
+                for key, mask in events:
+                    if key.fileobj is self.__wakeRecv:
+                        self.__clearWake()
+                        continue
                     if (mask & selectors.EVENT_READ):
                         for line in self.__buffered_readLine():
                             self.__processMessage(line)
                     if (mask & selectors.EVENT_WRITE):
                         self.__write()
-                # Sleep for period or until there is data in the write buffer.
-                # In theory if data is constantly available, this could block,
-                # in which case it may be better to self.__stopEvent.wait()
-                if self.__dataReadyEvent.wait(self.sleepPeriod):
-                    continue
-                continue
         except Exception as e:
+            if self.__stopEvent.is_set():
+                return  # disconnect() from another thread closed the socket/selector under us
             self.__die(f"Exception in client event loop: {repr(e)}", e)
 
     def __processMessage(self, message: bytes):
@@ -143,21 +345,41 @@ class Client(ExecutorEventEmitter):
             self.selector = self.client = None
             raise
         self.client.setblocking(False)
-        self.selector.register(self.client, (selectors.EVENT_READ | selectors.EVENT_WRITE))
+        # keep the OS from buffering a lot of data ahead of us, so that higher priority messages don't wait behind it
+        try:
+            self.client.setsockopt(SOL_SOCKET, SO_SNDBUF, self.SND_CHUNK_SZ)
+        except OSError:
+            pass
+        self.__wakeRecv, self.__wakeSend = socketpair()
+        self.__wakeRecv.setblocking(False)
+        self.__wakeSend.setblocking(False)
+        self.selector.register(self.client, selectors.EVENT_READ)
+        self.selector.register(self.__wakeRecv, selectors.EVENT_READ)
+        self.__writeWanted = False
         self.__stopEvent.clear()
 
     def __close(self):
         self.__stopEvent.set()
+        self.__wake()
         if self.__writeLock.locked():
             self.__writeLock.release()
         self.__sendBuffer.clear()
+        for lane in self.__lanes:
+            lane.clear()
         if not self.selector:
             return
         if self.selector.get_map():
             try:
                 self.selector.unregister(self.client)
+                self.selector.unregister(self.__wakeRecv)
             except Exception as e:
                 print(f"Error in selector.unregister(): {repr(e)}")
+        for sock in (self.__wakeRecv, self.__wakeSend):
+            try:
+                sock.close()
+            except (OSError, AttributeError):
+                pass
+        self.__wakeRecv = self.__wakeSend = None
         try:
             self.client.shutdown(SHUT_RDWR)
             self.client.close()
@@ -191,89 +413,49 @@ class Client(ExecutorEventEmitter):
     def isActionBeingHeld(self, actionId:str):
         return actionId in self.__heldActions
 
-    def createState(self, stateId:str, description:str, value:str):
-        if stateId and description and value != None:
-            if stateId not in self.currentStates:
-                self.send({"type": "createState", "id": stateId, "desc": description, "defaultValue": value})
-                self.currentStates[stateId] = value
-            else:
-                self.stateUpdate(stateId, value)
-
-    def createStateMany(self, states:list):
-        try:
-            for state in states:
-                if isinstance(state, dict):
-                    self.createState(state.get('id', ""), state.get('desc', ""), state.get('value', ""))
-                else:
-                    raise TypeError(f'createStateMany() requires a list of dicts, got {type(state)} instead.')
-        except:
-            raise TypeError(f'createStateMany() requires an iteratable, got {type(states)} instead.')
-
-    def removeState(self, stateId:str, validateExists = True):
-        if stateId and stateId in self.currentStates:
-            self.send({"type": "removeState", "id": stateId})
-            self.currentStates.pop(stateId)
-        elif validateExists:
-            raise Exception(f"{stateId} Does not exist.")
-
-    def removeStateMany(self, states:list):
-        try:
-            for state in states:
-                self.removeState(state, False)
-        except TypeError:
-            raise TypeError(f'removeStateMany() requires an iteratable, got {type(states)} instead.')
-
-    def choiceUpdate(self, choiceId:str, values:list):
-        if choiceId:
-            if isinstance(values, list):
-                self.send({"type": "choiceUpdate", "id": choiceId, "value": values})
-            else:
-                raise TypeError(f'choiceUpdate() values argument needs to be a list not a {type(values)}')
-
-    def choiceUpdateSpecific(self, stateId:str, values:list, instanceId:str):
-        if stateId and instanceId:
-            if isinstance(values, list):
-                self.send({"type": "choiceUpdate", "id": stateId, "instanceId": instanceId, "value": values})
-            else:
-                raise TypeError(f'choiceUpdateSpecific() values argument needs to be a list not a {type(values)}')
-
-    def settingUpdate(self, settingName:str, settingValue):
-        if settingName and settingName not in self.currentSettings or self.currentSettings[settingName] != settingValue:
-            self.send({"type": "settingUpdate", "name": settingName, "value": settingValue})
-            self.currentSettings[settingName] = settingValue
-
-    def stateUpdate(self, stateId:str, stateValue:str):
-        if stateId and stateId not in self.currentStates or self.currentStates[stateId] != stateValue:
-            self.send({"type": "stateUpdate", "id": stateId, "value": stateValue})
-            self.currentStates[stateId] = stateValue
-
-    def stateUpdateMany(self, states:list):
-        try:
-            for state in states:
-                if isinstance(state, dict):
-                    self.stateUpdate(state.get('id', ""), state.get('value', ""))
-                else:
-                    raise TypeError(f'StateUpdateMany() requires a list of dicts, got {type(state)} instead.')
-        except TypeError:
-            raise TypeError(f'StateUpdateMany() requires an iteratable, got {type(states)} instead.')
-
-    def updateActionData(self, instanceId:str, stateId:str, minValue, maxValue):
+    def send(self, data, priority=PRIORITY.normal):
         '''
-        TouchPortal currently only supports data.type "number"
+        This manages the massage to send. Messages with a higher `priority` (lower `PRIORITY` value) are
+        sent ahead of any lower priority ones which are still waiting to be sent.
         '''
-        self.send({"type": "updateActionData", "instanceId": instanceId, "data": {"minValue": minValue, "maxValue": maxValue, "id": stateId, "type": "number"}})
+        self.sendMany((data,), priority)
 
-    def send(self, data):
+    def sendMany(self, messages:list, priority=PRIORITY.normal):
         '''
-        This manages the massage to send
+        Sends a list of messages as one batch: they are serialized together and queued at once, with the same `priority`
+        as in `send()`. If the whole batch doesn't fit in the buffer then none of it is sent and `ResourceWarning` is raised.
         '''
+        if not messages:
+            return
+        encoded = [(jdumps(m) + '\n').encode() for m in messages]
+        size = sum(map(len, encoded))
         if self.__getWriteLock():
-            if len(self.__sendBuffer) + len(data) > self.SND_BUFFER_SZ:
+            pending = sum(lane.size for lane in self.__lanes)
+            if len(self.__sendBuffer) + pending + size > self.SND_BUFFER_SZ:
                 self.__writeLock.release()
                 raise ResourceWarning("TP Client send buffer is full!")
-            self.__sendBuffer += (jdumps(data)+'\n').encode()
+            wake = not self.__sendBuffer and not pending
+            for msg, data in zip(messages, encoded):
+                mid = msg.get('id')
+                lane = priority
+                if mid is not None:
+                    # never send a message ahead of an older one for the same ID
+                    lane = next((i for i in range(PRIORITY.bulk, priority, -1) if mid in self.__lanes[i].ids), priority)
+                self.__lanes[lane].push(mid, data, self.coalesceStates and msg.get('type') == "stateUpdate")
             self.__writeLock.release()
-            self.__dataReadyEvent.set()
+            if wake:
+                self.__wake()
+
+    def __hasPending(self):
+        return any(lane.queue for lane in self.__lanes)
+
+    def __fillSendBuffer(self):
+        # must hold __writeLock. Queued messages are only serialized into the send buffer once everything before
+        # them has been sent, and only up to SND_CHUNK_SZ at a time, so that higher priority messages queued in the
+        # meantime don't wait behind a lot of bulk data, and state updates can keep being replaced while backed up.
+        for lane in self.__lanes:
+            while lane.queue and len(self.__sendBuffer) < self.SND_CHUNK_SZ:
+                self.__sendBuffer += lane.pop()
 
     def connect(self):
         '''
@@ -294,24 +476,9 @@ class Client(ExecutorEventEmitter):
         if self.isConnected():
             self.__close()
 
-    @staticmethod
-    def getActionDataValue(data:list, valueId:str=None):
-        '''
-        Utility for processing action messages from TP. For example:
-            {"type": "action", "data": [{ "id": "data object id", "value": "user specified value" }, ...]}
-
-        Returns the `value` with specific `id` from a list of action data,
-        or `None` if the `id` wasn't found. If a null id is passed in `valueId`
-        then the first entry which has a `value` key, if any, will be returned.
 
-        Args:
-            `data`: the "data" array from a TP "action", "on", or "off" message
-            `valueId`: the "id" to look for in `data`. `None` or blank to return the first value found.
-        '''
-        if not data: return None
-        if valueId:
-            return next((x.get('value') for x in data if x.get('id', '') == valueId), None)
-        return next((x.get('value') for x in data if x.get('value') != None), None)
+# imported last since it uses the classes above
+from .aio import AsyncClient
 
 """
 from requests import (head as req_head, get as req_get)
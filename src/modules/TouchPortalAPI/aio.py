@@ -0,0 +1,121 @@
+import asyncio
+from json import (loads as jloads, dumps as jdumps)
+from pyee import AsyncIOEventEmitter
+from . import (TYPES, PRIORITY, ClientBase)
+
+class AsyncClient(AsyncIOEventEmitter, ClientBase):
+    '''
+    An `asyncio` based client for TouchPortal plugin integration, with the same API as `Client`.
+    Implements a [pyee.AsyncIOEventEmitter](https://pyee.readthedocs.io/en/latest/#pyee.AsyncIOEventEmitter):
+    event handlers may be coroutine functions, which are scheduled as tasks on the event loop, or regular
+    functions, which are called directly from the loop. Unlike `Client` there are no worker threads, so
+    all methods (including `send()` and the state update helpers) must be called from the event loop's thread.
+    From other threads use `loop.call_soon_threadsafe()`.
+
+    Args:
+        `pluginId`       (str): ID string of the TouchPortal plugin using this client.
+        `autoClose`     (bool): If `True` then this client will automatically disconnect when a `closePlugin` message is received from TP.
+        `checkPluginId` (bool): Validate that `pluginId` matches ours in any messages from TP which contain one (such as actions). Default is `True`.
+        `loop`        (object): The asyncio event loop to use for handlers. Default is the running loop at the time of the first event.
+    '''
+    TPHOST = '127.0.0.1'
+    TPPORT = 12136
+    RCV_BUFFER_SZ = 2**20  # [B] maximum length of one incoming message
+    SND_BUFFER_SZ = 32**4  # [B] maximum size of send data buffer (1MB)
+
+    def __init__(self, pluginId, autoClose=False, checkPluginId=True, loop=None):
+        super(AsyncClient, self).__init__(loop=loop)
+        self.pluginId = pluginId
+        self.autoClose = autoClose
+        self.checkPluginId = checkPluginId
+        self.currentStates = {}
+        self.currentSettings = {}
+        self.__heldActions = {}
+        self.__reader = None
+        self.__writer = None
+
+    def __processMessage(self, message: bytes):
+        data = jloads(message.decode())
+        if data and (act_type := data.get('type')):
+            if self.checkPluginId and (pid := data.get('pluginId')) and pid != self.pluginId:
+                return
+            if act_type == TYPES.onShutdown:
+                if self.autoClose: self.__close()
+            elif act_type == TYPES.onHold_down and (aid := data.get('actionId')):
+                self.__heldActions[aid] = True
+            elif act_type == TYPES.onHold_up and (aid := data.get('actionId')):
+                self.__heldActions.pop(aid, None)
+            self.__emitEvent(act_type, data)
+
+    def __emitEvent(self, ev, data):
+        self.emit(ev, data)
+        self.emit(TYPES.allMessage, data)
+
+    def __close(self):
+        if not self.__writer:
+            return
+        try:
+            self.__writer.close()
+        except OSError as e:
+            print(f"Error in socket.close(): {repr(e)}")
+        self.__writer = None
+
+    def isConnected(self):
+        return self.__writer is not None
+
+    def isActionBeingHeld(self, actionId:str):
+        return actionId in self.__heldActions
+
+    def send(self, data, priority=PRIORITY.normal):
+        '''
+        Queues a message to send to TouchPortal. Messages sent while not connected are discarded.
+        Messages are written to the transport right away, in order, so `priority` is ignored.
+        '''
+        self.sendMany((data,), priority)
+
+    def sendMany(self, messages:list, priority=PRIORITY.normal):
+        '''
+        Queues a list of messages to send to TouchPortal as one batch. If the whole batch doesn't fit
+        in the send buffer then none of it is sent and `ResourceWarning` is raised.
+        '''
+        if not self.__writer or not messages:
+            return
+        payload = ''.join([jdumps(m) + '\n' for m in messages]).encode()
+        if self.__writer.transport.get_write_buffer_size() + len(payload) > self.SND_BUFFER_SZ:
+            raise ResourceWarning("TP Client send buffer is full!")
+        self.__writer.write(payload)
+
+    async def connect(self):
+        '''
+        Connects to the TP Server and processes incoming messages until disconnected.
+        Does nothing if client is already connected.
+        '''
+        if self.isConnected():
+            return
+        self.__reader, self.__writer = await asyncio.open_connection(self.TPHOST, self.TPPORT, limit=self.RCV_BUFFER_SZ)
+        self.send({"type":"pair", "id": self.pluginId})
+        try:
+            while self.__writer:
+                if not (line := await self.__reader.readline()):
+                    if self.__writer:
+                        raise RuntimeError("Peer closed the connection.")
+                    break
+                self.__processMessage(line)
+                # let the transport catch up if we're sending faster than it can write
+                if self.__writer and self.__writer.transport.get_write_buffer_size() > self.SND_BUFFER_SZ // 2:
+                    await self.__writer.drain()
+        except Exception as e:
+            if self.__writer:
+                print(f"Exception in client event loop: {repr(e)}")
+                self.__emitEvent(TYPES.onShutdown, {"type": TYPES.onShutdown})
+                raise
+        finally:
+            self.__close()
+            self.__reader = None
+
+    def disconnect(self):
+        '''
+        This closes the connection to TP, which also makes `connect()` return.
+        Does nothing if client is already disconnected.
+        '''
+        self.__close()
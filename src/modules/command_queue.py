@@ -0,0 +1,105 @@
+'''
+CommandQueue runs commands posted from any thread one at a time, in order,
+on a single consumer thread, optionally coalescing redundant commands.
+'''
+
+__copyright__ = '''
+This file is part of the LGKeys TouchPortal Plugin project
+Copyright Maxim Paperno; all rights reserved.
+
+This file may be used under the terms of the GNU
+General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+A copy of the GNU General Public License is available at <http://www.gnu.org/licenses/>.
+'''
+
+from collections import deque
+from threading import Thread, Condition, current_thread
+from logging import getLogger
+import modules.utils as utils
+
+__all__ = ['CommandQueue']
+
+
+class CommandQueue(Thread):
+	'''
+	Commands are run in the order they were posted. A command posted with a `key` supersedes any
+	command with the same key which has not started running yet: the older one is dropped and the
+	new one is queued at the end, so it still runs after everything which was posted before it.
+	'''
+	def __init__(self, name = "CommandQueue"):
+		super(CommandQueue, self).__init__(name=name, daemon=True)
+		self.log = utils.Logger(getLogger(__name__))
+		self.coalesced = 0      # number of commands dropped because a newer one superseded them
+		self._cond = Condition()
+		self._queue = deque()   # [ [key, func, args, kwargs], ... ], func is None if superseded
+		self._keyed = {}        # { key : command, ... } for queued commands which have a key
+		self._stopped = False
+
+	def __len__(self):
+		with self._cond:
+			return len(self._queue)
+
+	def post(self, func, *args, key = None, **kwargs):
+		'''Queues `func(*args, **kwargs)` to run on the queue thread. Returns `False` if the queue has been stopped.'''
+		cmd = [key, func, args, kwargs]
+		with self._cond:
+			if self._stopped:
+				return False
+			if key is not None:
+				if (old := self._keyed.get(key)):
+					old[1] = None
+					self.coalesced += 1
+				self._keyed[key] = cmd
+			self._queue.append(cmd)
+			self._cond.notify()
+		return True
+
+	def cancel(self, key):
+		'''Drops the queued command with `key`, if any. Returns `True` if one was found.'''
+		with self._cond:
+			if (cmd := self._keyed.pop(key, None)):
+				cmd[1] = None
+				return True
+		return False
+
+	def isPending(self, key):
+		with self._cond:
+			return key in self._keyed
+
+	def isQueueThread(self):
+		return current_thread() is self
+
+	def run(self):
+		while True:
+			with self._cond:
+				while not self._queue and not self._stopped:
+					self._cond.wait()
+				if self._stopped:
+					return
+				cmd = self._queue.popleft()
+				key, func, args, kwargs = cmd
+				if key is not None and self._keyed.get(key) is cmd:
+					del self._keyed[key]
+			if func is None:
+				continue
+			try:
+				func(*args, **kwargs)
+			except Exception as e:
+				self.log.err(f"Exception in command {getattr(func, '__name__', repr(func))}: {repr(e)}")
+
+	def stop(self, timeout = None):
+		'''Discards any queued commands and waits up to `timeout` seconds for a running command to finish.'''
+		with self._cond:
+			self._stopped = True
+			self._queue.clear()
+			self._keyed.clear()
+			self._cond.notify()
+		if self.is_alive() and not self.isQueueThread():
+			self.join(timeout)
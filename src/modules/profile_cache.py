@@ -0,0 +1,184 @@
+'''
+ProfileCache is a persistent on-disk store of parsed game profiles, used to
+avoid re-parsing profile files which have not changed since the last run.
+'''
+
+__copyright__ = '''
+This file is part of the LGKeys TouchPortal Plugin project
+Copyright Maxim Paperno; all rights reserved.
+
+This file may be used under the terms of the GNU
+General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+A copy of the GNU General Public License is available at <http://www.gnu.org/licenses/>.
+'''
+
+import os
+import pickle
+from collections import OrderedDict
+from copy import copy
+from logging import getLogger
+from modules.profile_store import estimate_size
+import modules.utils as utils
+
+__all__ = ['ProfileCache']
+
+
+class ProfileCache():
+	'''
+	Cache entries are keyed on the profile file path and are only considered valid if
+	the file size, modification time and device type filter all match. Entries added with `put_header()`
+	only hold the profile header data, which doesn't depend on the device types, and are only returned by `get_header()`.
+	Fully parsed profiles are only kept up to a memory budget; past that the least recently used ones are reduced to
+	their header data. The profiles returned by `get()` share their macro and assignment data with the cached ones.
+
+	Args:
+		`fn`             (str): Full path of the cache file.
+		`max_entries`    (int): Maximum number of profiles to keep; the least recently modified files are dropped first.
+		`max_full_bytes` (int): Approximate memory budget for the fully parsed profiles, in bytes.
+	'''
+	VERSION = 5         # bump whenever the format of cached data (including GameProfile) changes
+	MAX_ENTRIES = 1000
+	MAX_FULL_BYTES = 32 * 1024 * 1024
+
+	def __init__(self, fn, max_entries=MAX_ENTRIES, max_full_bytes=MAX_FULL_BYTES):
+		self.log = utils.Logger(getLogger(__name__))
+		self.fn = fn
+		self.max_entries = max_entries
+		self.max_full_bytes = max_full_bytes
+		self.entries = {}   # { 'path' : (st_size, st_mtime_ns, (devices, ...) or None for header only, GameProfile), ... }
+		self.dirty = False
+		self._full = OrderedDict()   # { 'path' : size, ... } of the full profile entries, least recently used first
+		self.full_bytes = 0
+
+	@staticmethod
+	def _devices_key(devices):
+		return tuple(sorted(devices))
+
+	def _track_full(self, fn, profile):
+		self._untrack_full(fn)
+		self._full[fn] = size = estimate_size(profile)
+		self.full_bytes += size
+		# the most recently used profile is always kept, like in ProfileLRU
+		while len(self._full) > 1 and self.full_bytes > self.max_full_bytes:
+			old_fn, size = self._full.popitem(last=False)
+			self.full_bytes -= size
+			if (e := self.entries.get(old_fn)):
+				self.entries[old_fn] = (e[0], e[1], None, e[3].header())
+				self.dirty = True
+
+	def _untrack_full(self, fn):
+		if (size := self._full.pop(fn, None)) is not None:
+			self.full_bytes -= size
+
+	def load(self):
+		self.entries = {}
+		self._full.clear()
+		self.full_bytes = 0
+		self.dirty = False
+		if not self.fn or not os.path.isfile(self.fn):
+			return
+		try:
+			with open(self.fn, 'rb') as f:
+				data = pickle.load(f)
+			if not isinstance(data, dict) or data.get('version') != self.VERSION:
+				self.log.info(f"Discarding profile cache {self.fn} from a different version.")
+				self.dirty = True
+				return
+			self.entries = data.get('entries', {})
+			# treat the most recently modified profiles as the most recently used
+			for fn, e in sorted(self.entries.items(), key=lambda e: e[1][1]):
+				if e[2] is not None:
+					self._track_full(fn, e[3])
+			self.log.dbg(f"Loaded {len(self.entries)} cached profiles ({len(self._full)} full) from {self.fn}")
+		except Exception as e:
+			self.log.warn(f"Could not load profile cache {self.fn}, discarding. Error: {repr(e)}")
+			self.entries = {}
+			self.dirty = True
+
+	def save(self):
+		if not self.fn or not self.dirty:
+			return
+		if len(self.entries) > self.max_entries:
+			keep = sorted(self.entries.items(), key=lambda e: e[1][1], reverse=True)[:self.max_entries]
+			self.entries = dict(keep)
+			for fn in [fn for fn in self._full if fn not in self.entries]:
+				self._untrack_full(fn)
+		try:
+			data = {'version': self.VERSION, 'entries': self.entries}
+			utils.write_file_atomic(self.fn, lambda f: pickle.dump(data, f, pickle.HIGHEST_PROTOCOL), 'wb')
+			self.dirty = False
+			self.log.dbg(f"Saved {len(self.entries)} profiles to cache {self.fn}")
+		except Exception as e:
+			self.log.warn(f"Could not save profile cache {self.fn}. Error: {repr(e)}")
+
+	def get(self, fn, st, devices):
+		if (e := self.entries.get(fn)) and e[0] == st.st_size and e[1] == st.st_mtime_ns and e[2] == self._devices_key(devices):
+			self._full.move_to_end(fn)
+			profile = copy(e[3])
+			profile.path = fn
+			return profile
+		return None
+
+	def put(self, fn, st, devices, profile):
+		self.entries[fn] = (st.st_size, st.st_mtime_ns, self._devices_key(devices), copy(profile))
+		self._track_full(fn, profile)
+		self.dirty = True
+
+	def get_header(self, fn, st):
+		'''Returns the header data (see `GameProfile.header()`) from a valid full or header-only entry for `fn`.'''
+		if (e := self.entries.get(fn)) and e[0] == st.st_size and e[1] == st.st_mtime_ns:
+			header = e[3].header()
+			header.path = fn
+			return header
+		return None
+
+	def put_header(self, fn, st, profile):
+		'''Stores the header data of `profile`, unless there already is a valid entry for `fn`.'''
+		if (e := self.entries.get(fn)) and e[0] == st.st_size and e[1] == st.st_mtime_ns:
+			return
+		self.entries[fn] = (st.st_size, st.st_mtime_ns, None, profile.header())
+		self._untrack_full(fn)
+		self.dirty = True
+
+	def refresh(self, fn, st, header):
+		'''
+		Updates the stored file stats and header data of the cached entry for `fn` when LGS has re-saved the profile
+		without any meaningful changes. If `header` has a content hash it must match that of the entry.
+		Returns `True` if the entry was updated.
+		'''
+		if not (e := self.entries.get(fn)) or (header.chash and e[3].chash != header.chash):
+			return False
+		profile = copy(e[3])
+		profile.name = header.name
+		profile.lpd = header.lpd
+		profile.fsize = st.st_size
+		self.entries[fn] = (st.st_size, st.st_mtime_ns, e[2], profile)
+		self.dirty = True
+		return True
+
+	def remove(self, fn):
+		if self.entries.pop(fn, None):
+			self._untrack_full(fn)
+			self.dirty = True
+
+	def prune(self, path, keep_files):
+		'''Removes entries for any files in `path` which are not in the `keep_files` list.'''
+		path = os.path.normcase(os.path.abspath(path))
+		keep_files = set(keep_files)
+		for fn in [fn for fn in self.entries.keys() if fn not in keep_files and os.path.normcase(os.path.dirname(os.path.abspath(fn))) == path]:
+			del self.entries[fn]
+			self._untrack_full(fn)
+			self.dirty = True
+
+	def clear(self):
+		self.entries = {}
+		self._full.clear()
+		self.full_bytes = 0
+		self.dirty = True
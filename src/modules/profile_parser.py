@@ -20,15 +20,20 @@ GNU General Public License for more details.
 A copy of the GNU General Public License is available at <http://www.gnu.org/licenses/>.
 '''
 
+import hashlib
 import os
 import re
+import time
+from sys import intern
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass, field
 from datetime import datetime
+from html import unescape
 from logging import getLogger
 import xml.etree.ElementTree as ET
 import modules.utils as utils
 
-__all__ = ['GameProfileParser']
+__all__ = ['GameProfileParser', 'GK_DEV_DATA_MAP']
 
 # XML namespaces used in profile data, map to short versions for ElementTree parsing.
 GK_GP_XMLNS = {
@@ -43,35 +48,97 @@ GK_GP_XMLNS = {
 	'md': 'http://www.logitech.com/Cassandra/2010.1/Macros/Media',
 }
 
-@dataclass
+# Fully qualified tag names of the profile elements we care about, as reported by ET.iterparse().
+GK_TAG_PROFILE     = f"{{{GK_GP_XMLNS['pr']}}}profile"
+GK_TAG_DESCRIPTION = f"{{{GK_GP_XMLNS['pr']}}}description"
+GK_TAG_TARGET      = f"{{{GK_GP_XMLNS['pr']}}}target"
+GK_TAG_MACROS      = f"{{{GK_GP_XMLNS['pr']}}}macros"
+GK_TAG_MACRO       = f"{{{GK_GP_XMLNS['pr']}}}macro"
+GK_TAG_ASSIGNMENTS = f"{{{GK_GP_XMLNS['pr']}}}assignments"
+GK_TAG_ASSIGNMENT  = f"{{{GK_GP_XMLNS['pr']}}}assignment"
+
+# device name : (max keys, max states, profile contextId prefix, the LGS "family" code and suffix for TP State id)
+GK_DEV_DATA_MAP = {
+	"Keyboard"             : (18, 3, "G",      "kb"),
+	"LeftHandedController" : (29, 3, "G",      "lhc"),
+	"Mouse"                : (20, 1, "Button", "mouse"),
+	"Headset"              : ( 3, 1, "G",      "hs")  # not sure of "G"
+}
+
+# The profile data classes use __slots__ and interned ID strings to keep the memory footprint small,
+# since there can be many thousands of macros and assignments loaded at once.
+
 class GameMacro:
-	guid:str = ""
-	name:str = ""
-	mtype:str = ""  # macro type as name of subkey (future use?)
+	__slots__ = ('guid', 'name', 'mtype')
+
+	def __init__(self, guid:str = "", name:str = "", mtype:str = ""):
+		self.guid = intern(guid) if guid else ""
+		self.name = name
+		self.mtype = mtype  # macro type as name of subkey (future use?)
+
+	def __repr__(self):
+		return f"GameMacro(guid={self.guid!r}, name={self.name!r}, mtype={self.mtype!r})"
 
-@dataclass
 class GameAssignment:
-	macroguid:str = ""   # associated macro
-	contextid:str = ""   # associated key name
-	shiftstate:int = 1   # associated key memory slot (1-3)
+	__slots__ = ('macroguid', 'contextid', 'shiftstate')
+
+	def __init__(self, macroguid:str = "", contextid:str = "", shiftstate:int = 1):
+		self.macroguid = intern(macroguid) if macroguid else ""   # associated macro
+		self.contextid = intern(contextid) if contextid else ""   # associated key name
+		self.shiftstate = int(shiftstate)                         # associated key memory slot (1-3)
+
+	def __repr__(self):
+		return f"GameAssignment(macroguid={self.macroguid!r}, contextid={self.contextid!r}, shiftstate={self.shiftstate!r})"
 
-@dataclass
 class GameProfile:
-	guid: str = ""
-	name: str = ""
-	desc: str = ""
-	lpd: datetime = datetime(1970, 1, 1)   # last played (used) date
-	fsize: int = 0    # profile file size, for change tracking
-	targets: list = field(default_factory=list)      # associated application(s)
-	macros: dict = field(default_factory=dict)       # { 'macroguid' : GameMacro(), ... }
-	assignments: dict = field(default_factory=dict)  # { 'device_type' : { '<contextid>M<shiftstate>' : GameAssignment(), 'G2M1' : GameAssignment(), ... } , ... }
-	state_names: dict = field(default_factory=dict)  # { 'device_type' : {'m<shiftstate>':"name", 'm2':"Edit", ...}, ... }
-
-	def getMacroForDeviceKey(self, device, keyname):
-		if (a := self.assignments.get(device)) and (da := a.get(keyname)):
+	__slots__ = ('guid', 'name', 'desc', 'lpd', 'fsize', 'chash', 'targets', 'macros', 'assignments', 'state_names', 'key_tables', 'path')
+
+	def __init__(self, guid:str = "", name:str = "", desc:str = "", lpd:datetime = datetime(1970, 1, 1), fsize:int = 0, chash:bytes = b"",
+	             targets:list = None, macros:dict = None, assignments:dict = None, state_names:dict = None, key_tables:dict = None, path:str = ""):
+		self.guid = guid
+		self.name = name
+		self.desc = desc
+		self.lpd = lpd      # last played (used) date
+		self.fsize = fsize  # profile file size, for change tracking
+		self.chash = chash  # hash of the file contents after the <profile> tag, see ContentHashReader; not set by header-only parsing
+		self.targets = targets if targets is not None else []                # associated application(s)
+		self.macros = macros if macros is not None else {}                   # { 'macroguid' : GameMacro(), ... }
+		self.assignments = assignments if assignments is not None else {}    # { 'device_type' : { ('<contextid>', <shiftstate>) : GameAssignment(), ('G2', 1) : GameAssignment(), ... } , ... }
+		self.state_names = state_names if state_names is not None else {}    # { 'device_type' : {'m<shiftstate>':"name", 'm2':"Edit", ...}, ... }
+		self.key_tables = key_tables if key_tables is not None else {}       # { 'device_type' : ( ("key 1 slot 1 macro name", None, ...), (<key 2 slots>), ... ), ... }
+		self.path = path    # file the profile was read from
+
+	def __repr__(self):
+		return (f"GameProfile(guid={self.guid!r}, name={self.name!r}, lpd={self.lpd!r}, fsize={self.fsize!r}, targets={self.targets!r}, "
+		        f"macros: {len(self.macros)}, assignments: {{{', '.join(f'{d}: {len(a)}' for d, a in self.assignments.items())}}})")
+
+	def getMacroForDeviceKey(self, device, contextid, shiftstate):
+		if (a := self.assignments.get(device)) and (da := a.get((contextid, shiftstate))):
 			return self.macros.get(da.macroguid)
 		return None
 
+	def header(self):
+		'''Returns a copy of this profile with only the "header" data (no macros, assignments or key tables).'''
+		return GameProfile(self.guid, self.name, self.desc, self.lpd, self.fsize, self.chash, self.targets, state_names=self.state_names, path=self.path)
+
+	def getKeyTable(self, device):
+		'''Returns the macro names table for a device type, indexed as `[key - 1][shift state - 1]`. Unmapped slots are `None`.'''
+		return self.key_tables.get(device)
+
+	def buildKeyTables(self):
+		self.key_tables = {}
+		for device, assigns in self.assignments.items():
+			max_keys, max_sts, key_pfx, _ = GK_DEV_DATA_MAP.get(device, (0, 0, "", ""))
+			table = []
+			for key in range(1, max_keys+1):
+				names = []
+				contextid = f"{key_pfx}{key}"
+				for state in range(1, max_sts+1):
+					macro = (a := assigns.get((contextid, state))) and self.macros.get(a.macroguid)
+					names.append(macro.name if macro else None)
+				table.append(tuple(names))
+			self.key_tables[device] = tuple(table)
+
 	def getStateNames(self, device, max_slots=3):
 		names = self.state_names.get(device, {})
 		a_names = self.state_names.get("any", {})
@@ -81,11 +148,184 @@ class GameProfile:
 				names[key] = a_names.get(key, key.upper())
 		return names
 
+	def diff(self, other, devices):
+		'''
+		Compares this profile with `other` (eg. a newer version of the same profile, or a different profile)
+		for all the device types in `devices` and returns a `GameProfileDiff` with the differences.
+		'''
+		ret = GameProfileDiff(name_changed = self.name != other.name)
+		for device in devices:
+			max_keys, max_sts, key_pfx, dev_code = GK_DEV_DATA_MAP.get(device, (0, 0, "", ""))
+			old_table = self.getKeyTable(device)
+			new_table = other.getKeyTable(device)
+			if old_table != new_table:
+				for key in range(max_keys):
+					old_names = old_table[key] if old_table else (None,) * max_sts
+					new_names = new_table[key] if new_table else (None,) * max_sts
+					if old_names == new_names:
+						continue
+					for state in range(max_sts):
+						if old_names[state] != new_names[state]:
+							ret.keys.append((device, key+1, state+1, old_names[state], new_names[state]))
+		for max_keys, max_sts, key_pfx, dev_code in GK_DEV_DATA_MAP.values():
+			if max_sts < 2:
+				continue
+			old_names = self.getStateNames(dev_code, max_sts)
+			new_names = other.getStateNames(dev_code, max_sts)
+			for slot, name in new_names.items():
+				if old_names.get(slot) != name:
+					ret.state_names.append((dev_code, slot, old_names.get(slot), name))
+		return ret
+
+
+@dataclass
+class GameProfileDiff:
+	name_changed: bool = False
+	keys: list = field(default_factory=list)         # [ ('device_type', key, shiftstate, "old macro name" | None, "new macro name" | None), ... ]
+	state_names: list = field(default_factory=list)  # [ ('device code', 'm<shiftstate>', "old name", "new name"), ... ]
+
+	def __bool__(self):
+		return self.name_changed or bool(self.keys) or bool(self.state_names)
+
+	def describe(self, max_items=10):
+		'''Returns a short human-readable summary of the changes, for logging.'''
+		if not self:
+			return "no changes"
+		parts = []
+		if self.name_changed:
+			parts.append("profile name")
+		if self.keys:
+			items = [f"{dev} {GK_DEV_DATA_MAP[dev][2]}{key}M{st}: '{old or ''}' -> '{new or ''}'" for dev, key, st, old, new in self.keys[:max_items]]
+			if len(self.keys) > max_items:
+				items.append("...")
+			parts.append(f"{len(self.keys)} key(s) [{', '.join(items)}]")
+		if self.state_names:
+			items = [f"{dev}.{slot}: '{old}' -> '{new}'" for dev, slot, old, new in self.state_names[:max_items]]
+			parts.append(f"{len(self.state_names)} slot name(s) [{', '.join(items)}]")
+		return "; ".join(parts)
+
+
+class ContentHashReader():
+	"""
+	File-like wrapper which hashes the file contents after the <profile> start tag as they are read through it.
+	LGS rewrites the tag attributes (eg. the last played date) on every profile switch, so two versions of a file
+	with the same content hash differ at most in the profile name and last played date.
+	"""
+	def __init__(self, f, rx_profile_tag, head_size):
+		self.f = f
+		self.rx_profile_tag = rx_profile_tag
+		self.head_size = head_size   # the tag must end within this many bytes from the start of the file
+		self.head = b""              # start of the file, kept until we know where the tag ends
+		self.hasher = hashlib.blake2b(digest_size=16)
+
+	def read(self, size=-1):
+		data = self.f.read(size)
+		self._update(data)
+		return data
+
+	def _update(self, data):
+		if self.head is None:
+			self.hasher.update(data)
+			return
+		self.head += data
+		if data and len(self.head) < self.head_size:
+			return
+		if (m := self.rx_profile_tag.search(self.head, 0, self.head_size)):
+			self.hasher.update(memoryview(self.head)[m.end():])
+		else:
+			self.hasher.update(self.head)
+		self.head = None
+
+	def digest(self):
+		'''Reads (and hashes) the rest of the file and returns the content hash.'''
+		while self.read(1 << 16):
+			pass
+		return self.hasher.digest()
+
+
+class ProfileQuarantine():
+	"""
+	Keeps track of profile files which failed to parse, keyed on path, size and modification time.
+	A quarantined file is skipped until it changes. Failures which look transient, like a locked file
+	or one which was written very recently (probably caught in the middle of a save), are instead
+	scheduled for a retry with exponential backoff, up to `MAX_RETRIES` times.
+	"""
+	RETRY_DELAY = 0.25    # [s] delay before the first retry, doubled for each following one
+	MAX_RETRIES = 5
+	RECENT_WRITE = 2.0    # [s] parse errors in files modified less than this long ago are considered transient
 
-class GameProfileParser():
 	def __init__(self):
+		self._entries = {}   # { 'path' : (st_size, st_mtime_ns, failure count, retry time (monotonic) or None), ... }
+
+	def __len__(self):
+		return len(self._entries)
+
+	def isBlocked(self, fn, st):
+		if not (e := self._entries.get(fn)) or e[0] != st.st_size or e[1] != st.st_mtime_ns:
+			return False
+		return e[3] is None or time.monotonic() < e[3]
+
+	def add(self, fn, st, exc):
+		'''Records a failure and returns the delay until the next retry, or `None` if the file will not be retried.'''
+		failures = 1
+		if (e := self._entries.get(fn)) and e[0] == st.st_size and e[1] == st.st_mtime_ns:
+			failures = e[2] + 1
+		delay = None
+		if failures <= self.MAX_RETRIES and (isinstance(exc, OSError) or time.time() - st.st_mtime_ns / 1e9 < self.RECENT_WRITE):
+			delay = self.RETRY_DELAY * 2 ** (failures - 1)
+		self._entries[fn] = (st.st_size, st.st_mtime_ns, failures, time.monotonic() + delay if delay is not None else None)
+		return delay
+
+	def remove(self, fn):
+		self._entries.pop(fn, None)
+
+	def prune(self, path, keep_files):
+		'''Removes entries for any files in `path` which are not in the `keep_files` list.'''
+		path = os.path.normpath(path)
+		keep_files = set(keep_files)
+		for fn in [fn for fn in self._entries.keys() if fn not in keep_files and os.path.normpath(os.path.dirname(fn)) == path]:
+			del self._entries[fn]
+
+	def nextRetryDelay(self):
+		'''Returns the number of seconds until the next scheduled retry, or `None` if there are no retries pending.'''
+		if not (times := [e[3] for e in self._entries.values() if e[3] is not None]):
+			return None
+		return max(0.0, min(times) - time.monotonic())
+
+	def dueRetries(self):
+		'''
+		Returns a list of file paths which are due to be retried. Each returned entry is rescheduled with the next
+		backoff delay (or not retried again after `MAX_RETRIES`), in case the retry doesn't get as far as parsing the file.
+		Entries for files which no longer exist are removed.
+		'''
+		now = time.monotonic()
+		ret = []
+		for fn, e in list(self._entries.items()):
+			if e[3] is None or e[3] > now:
+				continue
+			if not os.path.isfile(fn):
+				del self._entries[fn]
+				continue
+			retry = now + self.RETRY_DELAY * 2 ** e[2] if e[2] < self.MAX_RETRIES else None
+			self._entries[fn] = (e[0], e[1], e[2], retry)
+			ret.append(fn)
+		return ret
+
+
+class GameProfileParser():
+	PARALLEL_MIN_FILES = 16   # below this number of files parse_profiles() doesn't bother with a process pool
+	SNIFF_BYTES = 4096        # how much of a file sniff_profile_header() reads looking for the <profile> tag
+
+	def __init__(self, cache=None):
 		self.log = utils.Logger(getLogger(__name__))
+		self.cache = cache   # optional ProfileCache
+		self.quarantine = ProfileQuarantine()
+		self._pool = None    # ProcessPoolExecutor used by parse_profiles(), kept between calls, see close()
+		self._pool_workers = 0
 		self.rx_state_names = re.compile(r"(?:(?:([a-z]+)\.)?M(\d):([^;]+)(?:;|\Z)\s*)", re.I)
+		# attribute values may contain a literal '>', so quoted strings are matched as a whole
+		self.rx_profile_tag = re.compile(rb"<profile\s((?:[^>\"']|\"[^\"]*\"|'[^']*')*)>")
+		self.rx_tag_attribs = re.compile(rb"([\w:.-]+)\s*=\s*(?:\"([^\"]*)\"|'([^']*)')")
 
 	def parse_state_names(self, text):
 		ret = {}
@@ -100,73 +340,193 @@ class GameProfileParser():
 		# self.log.dbg(f"'{text}' {repr(ret)}")
 		return ret
 
-	def parse_profile(self, fn, devices=[], header_only=False):
-		log = self.log
-		log.dbg(f"Loading profile from {fn}")
+	def sniff_profile_header(self, fn, with_hash=False):
+		"""
+		Returns a GameProfile with only the guid, name, lpd and fsize members set, read directly
+		from the <profile> tag at the start of the file. This is much quicker than even a header-only parse.
+		With `with_hash` the rest of the file is also read to set the `chash` member (still much quicker than parsing).
+		Falls back to `parse_profile(fn, header_only=True)` if the tag can't be found or is incomplete.
+		"""
 		try:
-			prof = ET.parse(fn).getroot().find('pr:profile', GK_GP_XMLNS)
-			if not prof:
-				log.warn(f"Could not find 'profile' element in XML tree!")
-				return None
-			# log.dbg(f"Root: {rootel.tag}; Prof: {prof}")
-			new_prof = GameProfile(prof.get('guid'), prof.get('name'))
+			with open(fn, 'rb') as f:
+				reader = ContentHashReader(f, self.rx_profile_tag, self.SNIFF_BYTES) if with_hash else f
+				data = reader.read(self.SNIFF_BYTES)
+				fsize = os.fstat(f.fileno()).st_size
+				if (m := self.rx_profile_tag.search(data, 0, self.SNIFF_BYTES)):
+					attribs = {k: unescape((v1 or v2).decode('utf-8')) for k, v1, v2 in self.rx_tag_attribs.findall(m.group(1))}
+					new_prof = GameProfile(attribs.get(b'guid'), attribs.get(b'name'))
+					if new_prof.guid and new_prof.name:
+						if lpd := attribs.get(b'lastplayeddate'):
+							try: new_prof.lpd = datetime.strptime(lpd, "%Y-%m-%dT%H:%M:%S")
+							except: pass
+						new_prof.fsize = fsize
+						new_prof.path = fn
+						if with_hash:
+							new_prof.chash = reader.digest()
+						return new_prof
+		except Exception as e:
+			self.log.dbg(f"Could not sniff profile header from {fn}: {repr(e)}")
+		return self.parse_profile(fn, header_only=True)
 
-			if not new_prof.guid or not new_prof.name:
-				log.warn(f"Profile was parsed but had no GUID and/or Name.")
-				return None
+	def parse_profile(self, fn, devices=[], header_only=False, st=None, force=False):
+		'''
+		Parses one profile file and returns a GameProfile, or `None` on failure. If `st` is given it is used
+		instead of calling `os.stat()`; it must have at least `st_size` and `st_mtime_ns` members.
+		With `force` the file is parsed even if it is quarantined, eg. to retry it.
+		'''
+		try:
+			if st is None:
+				st = os.stat(fn)
+		except Exception as e:
+			self.log.err(f"Error parsing {fn}: {e}")
+			return None
+		if self.cache and (new_prof := self.cache.get_header(fn, st) if header_only else self.cache.get(fn, st, devices)):
+			self.log.dbg(f"Using cached profile for {fn}")
+			self.quarantine.remove(fn)
+			return new_prof
+		if not force and self.quarantine.isBlocked(fn, st):
+			self.log.dbg(f"Skipping quarantined profile {fn}")
+			return None
+		new_prof, exc = self._try_load_profile(fn, st, devices, header_only)
+		self._record_result(fn, st, exc)
+		if new_prof and self.cache:
+			if header_only:
+				self.cache.put_header(fn, st, new_prof)
+			else:
+				self.cache.put(fn, st, devices, new_prof)
+		return new_prof
 
-			new_prof.fsize = os.stat(fn).st_size
+	def _try_load_profile(self, fn, st, devices, header_only):
+		# Returns a tuple of (GameProfile, None) on success or (None, Exception) on failure. Errors are logged
+		# by _record_result() since this also runs in pool worker processes, which have no logging set up.
+		try:
+			return self._load_profile(fn, st, devices, header_only), None
+		except Exception as e:
+			return None, e
 
-			if lpd := prof.get('lastplayeddate'):
-				try: new_prof.lpd = datetime.strptime(lpd, "%Y-%m-%dT%H:%M:%S")
-				except: pass
+	def _record_result(self, fn, st, exc):
+		if exc is None:
+			self.quarantine.remove(fn)
+			return
+		self.log.err(f"Error parsing {fn}: {exc}")
+		if (retry := self.quarantine.add(fn, st, exc)) is not None:
+			self.log.dbg(f"Will retry loading {fn} in {retry:.2f}s")
+		else:
+			self.log.warn(f"Profile {fn} is quarantined until it changes.")
 
-			if (desc := prof.findall('pr:description', GK_GP_XMLNS)):
-				new_prof.desc = "".join(desc[0].itertext())
-				new_prof.state_names = self.parse_state_names(new_prof.desc)
+	def _load_profile(self, fn, st, devices, header_only):
+		self.log.dbg(f"Loading profile from {fn}")
+		with open(fn, 'rb') as f:
+			# a header-only parse stops reading early, so only full parses hash the contents as they go
+			reader = f if header_only else ContentHashReader(f, self.rx_profile_tag, self.SNIFF_BYTES)
+			new_prof = self._iterparse_profile(reader, devices, header_only)
+			if not new_prof:
+				raise ValueError("Could not find 'profile' element in XML tree!")
+			if not new_prof.guid or not new_prof.name:
+				raise ValueError("Profile was parsed but had no GUID and/or Name.")
+			if not header_only:
+				new_prof.chash = reader.digest()
+		new_prof.fsize = st.st_size
+		new_prof.path = fn
+		# self.log.dbg(f"Profile: {vars(new_prof)}\n\n")
+		return new_prof
 
-			for tgt in prof.iterfind('pr:target', GK_GP_XMLNS):
-				if (tpath := tgt.get('path')):
-					new_prof.targets.append(tpath)
+	def _iterparse_profile(self, source, devices, header_only):
+		# Streaming parse of the profile XML. Elements are discarded as soon as they have been
+		# handled, and with header_only we stop reading at the first macros/assignments section.
+		new_prof = None
+		root = None
+		depth = 0
+		devcat = None   # current assignments device type, or None if skipping this device
+		for event, el in ET.iterparse(source, events=('start', 'end')):
+			if event == 'start':
+				depth += 1
+				if root is None:
+					root = el
+				elif depth == 2 and el.tag == GK_TAG_PROFILE:
+					new_prof = GameProfile(el.get('guid'), el.get('name'))
+					if lpd := el.get('lastplayeddate'):
+						try: new_prof.lpd = datetime.strptime(lpd, "%Y-%m-%dT%H:%M:%S")
+						except: pass
+				elif depth == 3 and new_prof:
+					if el.tag in (GK_TAG_MACROS, GK_TAG_ASSIGNMENTS) and (header_only or not new_prof.guid or not new_prof.name):
+						break
+					if el.tag == GK_TAG_ASSIGNMENTS:
+						# devicecategory is: Logitech.Gaming.<device_type>[.<model>]
+						# we only match on the actual device type and (optionally) model
+						devcat_arry = el.get('devicecategory', "").split('.')
+						devcat = devcat_arry[2] if ".".join(devcat_arry[2:]) in devices else None
+						if devcat:
+							devcat = intern(devcat)
+							new_prof.assignments[devcat] = {}  # just keep the base device type
+				continue
 
-			if header_only:
-				return new_prof
-
-			for macro in prof.iterfind('./pr:macros/pr:macro', GK_GP_XMLNS):
-				if macro.get('hidden', "false") == "true" or macro.get('backupguid', None):
-					continue
-				new_macro = GameMacro(macro.get('guid'), macro.get('name'))
-				if not new_macro.guid or not new_macro.name or not len(macro):
-					continue
-				new_macro.mtype = list(macro)[0].tag.split("}", 1)[1]
-				new_prof.macros[new_macro.guid] = new_macro
-				# log.dbg(f"Macro: {vars(new_macro)}")
-
-			for assign_device in prof.iterfind('pr:assignments', GK_GP_XMLNS):
-				# devicecategory is: Logitech.Gaming.<device_type>[.<model>]
-				# we only match on the actual device type and (optionally) model
-				devcat_arry = assign_device.get('devicecategory', "").split('.')
-				devcat = ".".join(devcat_arry[2:])
-				if devcat not in devices:
-					continue
-				devcat = devcat_arry[2]  # just keep the base device type
-				new_prof.assignments[devcat] = {}
-				for assign in assign_device.iterfind('pr:assignment', GK_GP_XMLNS):
-					if assign.get('backup', "") == "true":
-						continue
-					new_assign = GameAssignment(assign.get('macroguid'), assign.get('contextid'), assign.get('shiftstate'))
-					if not new_assign.macroguid:
-						continue
-					new_prof.assignments[devcat][f"{new_assign.contextid}M{new_assign.shiftstate}"] = new_assign
-					# log.dbg(f"Assignment: {vars(new_assign)}")
-			# log.dbg(f"Profile: {vars(new_prof)}\n\n")
-			return new_prof
-		except Exception as e:
-			log.err(f"Error parsing {fn}: {e}")
-			return None
+			# 'end' event
+			depth -= 1
+			if not new_prof:
+				if depth == 1 and el.tag == GK_TAG_PROFILE:
+					break  # only the first profile element is used
+				continue
+			if depth == 3:
+				if el.tag == GK_TAG_MACRO:
+					self._add_macro(new_prof, el)
+					el.clear()
+				elif el.tag == GK_TAG_ASSIGNMENT:
+					if devcat:
+						self._add_assignment(new_prof, devcat, el)
+					el.clear()
+			elif depth == 2:
+				if el.tag == GK_TAG_DESCRIPTION:
+					if not new_prof.desc:
+						new_prof.desc = "".join(el.itertext())
+						new_prof.state_names = self.parse_state_names(new_prof.desc)
+				elif el.tag == GK_TAG_TARGET:
+					if (tpath := el.get('path')):
+						new_prof.targets.append(tpath)
+				elif el.tag == GK_TAG_ASSIGNMENTS:
+					devcat = None
+				el.clear()
+			elif depth == 1:
+				break  # end of profile element
+		if root is not None:
+			root.clear()
+		if new_prof and not header_only:
+			new_prof.buildKeyTables()
+		return new_prof
 
+	def _add_macro(self, prof, macro):
+		if macro.get('hidden', "false") == "true" or macro.get('backupguid', None):
+			return
+		new_macro = GameMacro(macro.get('guid'), macro.get('name'))
+		if not new_macro.guid or not new_macro.name or not len(macro):
+			return
+		new_macro.mtype = intern(macro[0].tag.split("}", 1)[1])
+		prof.macros[new_macro.guid] = new_macro
+		# self.log.dbg(f"Macro: {vars(new_macro)}")
 
-	def parse_profiles(self, path, devices):
+	def _add_assignment(self, prof, devcat, assign):
+		if assign.get('backup', "") == "true":
+			return
+		try:
+			new_assign = GameAssignment(assign.get('macroguid'), assign.get('contextid'), assign.get('shiftstate', 1))
+		except ValueError:
+			return  # invalid shiftstate
+		if not new_assign.macroguid:
+			return
+		prof.assignments[devcat][(new_assign.contextid, new_assign.shiftstate)] = new_assign
+		# self.log.dbg(f"Assignment: {vars(new_assign)}")
+
+
+	def parse_profiles(self, path, devices, workers=1, header_only=False, cancel=None):
+		"""
+		Parses all profiles found in `path` and returns a dict of `{guid: GameProfile}`.
+		If `cancel` is given it is called between files and if it returns `True` parsing stops and `None` is returned.
+		With `header_only` the returned profiles only contain the header data (see `GameProfile.header()`).
+		Profiles found in the `cache`, if any, are not parsed again.
+		If `workers` is > 1 the files are distributed over a pool of that many processes
+		(`0` or `None` uses the CPU count). Files are always handled in sorted order,
+		so the result does not depend on which worker finishes first.
+		"""
 		log = self.log
 		profiles = {}
 		if not path:
@@ -174,11 +534,88 @@ class GameProfileParser():
 		log.dbg(f"Loading profiles from {path}")
 		try:
 			with os.scandir(path) as it:
-				for entry in it:
-					if entry.is_file and entry.name.endswith(".xml"):
-						if new_prof := self.parse_profile(entry.path, devices):
-							profiles[new_prof.guid] = new_prof
+				files = sorted((entry.path, entry.stat()) for entry in it if entry.is_file() and entry.name.endswith(".xml"))
 		except Exception as e:
 			log.warn(f"Error while handling profile directory {path} for {devices}: {e}")
+			return profiles
+
+		results = {}
+		to_parse = []
+		for fn, st in files:
+			if self.cache and (new_prof := self.cache.get_header(fn, st) if header_only else self.cache.get(fn, st, devices)):
+				results[fn] = new_prof
+			elif not self.quarantine.isBlocked(fn, st):
+				to_parse.append((fn, st))
+		if self.cache:
+			log.dbg(f"Found {len(results)} cached profiles, parsing {len(to_parse)}")
+
+		if not workers:
+			workers = os.cpu_count() or 1
+		parsed = None
+		if workers > 1 and len(to_parse) >= self.PARALLEL_MIN_FILES:
+			log.dbg(f"Parsing {len(to_parse)} profiles using up to {workers} processes")
+			try:
+				pool = self._get_pool(workers)
+				chunksize = max(1, len(to_parse) // (workers * 4))
+				futures = [pool.submit(_parse_profiles_worker, to_parse[i:i+chunksize], devices, header_only) for i in range(0, len(to_parse), chunksize)]
+				parsed = []
+				for future in futures:
+					if cancel and cancel():
+						for f in futures:
+							f.cancel()
+						log.dbg("Profile loading cancelled.")
+						return None
+					parsed.extend(future.result())
+			except Exception as e:
+				log.warn(f"Parallel profile loading failed, reverting to sequential mode. Error: {repr(e)}")
+				self.close()  # a broken pool can't be used again
+				parsed = None
+		if parsed is None:
+			parsed = (self._try_load_profile(fn, st, devices, header_only) for fn, st in to_parse)
+
+		for (fn, st), (new_prof, exc) in zip(to_parse, parsed):
+			if cancel and cancel():
+				log.dbg("Profile loading cancelled.")
+				return None
+			self._record_result(fn, st, exc)
+			results[fn] = new_prof
+			if new_prof and self.cache:
+				if header_only:
+					self.cache.put_header(fn, st, new_prof)
+				else:
+					self.cache.put(fn, st, devices, new_prof)
+
+		for fn, _ in files:
+			if (new_prof := results.get(fn)):
+				profiles[new_prof.guid] = new_prof
+
+		if self.cache:
+			self.cache.prune(path, (fn for fn, _ in files))
+			self.cache.save()
+		self.quarantine.prune(path, (fn for fn, _ in files))
 
 		return profiles
+
+	def _get_pool(self, workers):
+		if self._pool and self._pool_workers != workers:
+			self.close()
+		if not self._pool:
+			self._pool = ProcessPoolExecutor(max_workers=workers)
+			self._pool_workers = workers
+		return self._pool
+
+	def close(self):
+		'''Shuts down the worker processes used by `parse_profiles()`, if any. They are started again when needed.'''
+		if self._pool:
+			self._pool.shutdown(wait=False, cancel_futures=True)
+			self._pool = None
+
+
+# Parser instance used by each parse_profiles() pool worker process.
+_g_worker_parser = None
+
+def _parse_profiles_worker(files, devices, header_only):
+	global _g_worker_parser
+	if _g_worker_parser is None:
+		_g_worker_parser = GameProfileParser()
+	return [_g_worker_parser._try_load_profile(fn, st, devices, header_only) for fn, st in files]
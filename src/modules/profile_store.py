@@ -0,0 +1,207 @@
+'''
+In-memory storage helpers for parsed game profiles.
+ProfileRegistry indexes the known profiles by ID, name and last played date.
+ProfileLRU keeps a bounded set of fully parsed profiles, evicting the least
+recently used ones when either the count or memory budget limit is reached.
+'''
+
+__copyright__ = '''
+This file is part of the LGKeys TouchPortal Plugin project
+Copyright Maxim Paperno; all rights reserved.
+
+This file may be used under the terms of the GNU
+General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+A copy of the GNU General Public License is available at <http://www.gnu.org/licenses/>.
+'''
+
+import sys
+from bisect import (bisect_left, insort)
+from collections import OrderedDict
+from datetime import datetime
+from logging import getLogger
+import modules.utils as utils
+
+__all__ = ['ProfileRegistry', 'ProfileLRU', 'estimate_size']
+
+
+def estimate_size(obj):
+	'''Returns an approximate deep memory size of `obj` in bytes, following containers and object attributes.'''
+	seen = set()
+	size = 0
+	stack = [obj]
+	while stack:
+		o = stack.pop()
+		if id(o) in seen:
+			continue
+		seen.add(id(o))
+		size += sys.getsizeof(o)
+		if isinstance(o, dict):
+			stack.extend(o.keys())
+			stack.extend(o.values())
+		elif isinstance(o, (list, tuple, set, frozenset)):
+			stack.extend(o)
+		else:
+			if hasattr(o, '__dict__'):
+				stack.append(vars(o))
+			for cls in type(o).__mro__:
+				for attr in getattr(cls, '__slots__', ()):
+					if hasattr(o, attr):
+						stack.append(getattr(o, attr))
+	return size
+
+
+class ProfileRegistry():
+	'''
+	A dict-like container of `{guid: GameProfile}` which also maintains indexes by profile name and
+	last played date, as well as a sorted list of all profile names. Use `setLastPlayed()` to change
+	a profile's `lpd` so the ordering stays current. GUIDs are matched case-insensitively, so an ID taken from
+	a file name finds the profile even if the case differs from the one in the XML.
+	'''
+	EPOCH = datetime(1970, 1, 1)
+
+	def __init__(self, profiles=None):
+		self._profiles = {}   # { 'GUID' : GameProfile, ... } keyed by the upper case guid, see _key()
+		self._by_name = {}    # { 'name' : ['GUID', ...], ... }
+		self._by_lpd = []     # [ (lpd, 'GUID'), ... ] sorted by date
+		self._names = []      # sorted profile names
+		if profiles:
+			for prof in profiles.values():
+				self.add(prof)
+
+	@staticmethod
+	def _key(guid):
+		return guid.upper() if guid else guid
+
+	def __contains__(self, guid):
+		return self._key(guid) in self._profiles
+
+	def __len__(self):
+		return len(self._profiles)
+
+	def __iter__(self):
+		return iter(self._profiles)
+
+	def __getitem__(self, guid):
+		return self._profiles[self._key(guid)]
+
+	def get(self, guid, default=None):
+		return self._profiles.get(self._key(guid), default)
+
+	def items(self):
+		return self._profiles.items()
+
+	def values(self):
+		return self._profiles.values()
+
+	def add(self, profile):
+		self.pop(profile.guid)
+		key = self._key(profile.guid)
+		self._profiles[key] = profile
+		self._by_name.setdefault(profile.name, []).append(key)
+		insort(self._by_lpd, (profile.lpd, key))
+		insort(self._names, profile.name)
+
+	def pop(self, guid, default=None):
+		guid = self._key(guid)
+		if not (profile := self._profiles.pop(guid, None)):
+			return default
+		if (guids := self._by_name.get(profile.name)):
+			guids.remove(guid)
+			if not guids:
+				del self._by_name[profile.name]
+		self._removeSorted(self._by_lpd, (profile.lpd, guid))
+		self._removeSorted(self._names, profile.name)
+		return profile
+
+	def byName(self, name):
+		'''Returns the first profile added with `name`, if any.'''
+		if (guids := self._by_name.get(name)):
+			return self._profiles.get(guids[0])
+		return None
+
+	def lastPlayed(self):
+		'''Returns the profile with the newest last played date, or `None` if none have a date set.'''
+		if self._by_lpd and self._by_lpd[-1][0] > self.EPOCH:
+			return self._profiles.get(self._by_lpd[-1][1])
+		return None
+
+	def setLastPlayed(self, guid, lpd):
+		guid = self._key(guid)
+		if (profile := self._profiles.get(guid)) and profile.lpd != lpd:
+			self._removeSorted(self._by_lpd, (profile.lpd, guid))
+			profile.lpd = lpd
+			insort(self._by_lpd, (lpd, guid))
+
+	def names(self):
+		'''Returns a sorted list of all profile names.'''
+		return list(self._names)
+
+	@staticmethod
+	def _removeSorted(lst, item):
+		if (i := bisect_left(lst, item)) < len(lst) and lst[i] == item:
+			del lst[i]
+
+
+class ProfileLRU():
+	'''
+	Args:
+		`max_profiles` (int): Maximum number of profiles to keep.
+		`max_bytes`    (int): Approximate memory budget for all kept profiles, in bytes.
+
+	The most recently used profile is never evicted, even if it alone exceeds the memory budget.
+	'''
+	def __init__(self, max_profiles=8, max_bytes=32 * 1024 * 1024):
+		self.log = utils.Logger(getLogger(__name__))
+		self.max_profiles = max(1, max_profiles)
+		self.max_bytes = max_bytes
+		self.size_bytes = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self._items = OrderedDict()   # { 'guid' : (GameProfile, size), ... } in order of use, oldest first
+
+	def __contains__(self, guid):
+		return guid in self._items
+
+	def __len__(self):
+		return len(self._items)
+
+	def get(self, guid):
+		if (item := self._items.get(guid)):
+			self._items.move_to_end(guid)
+			self.hits += 1
+			return item[0]
+		self.misses += 1
+		return None
+
+	def put(self, profile):
+		self.remove(profile.guid)
+		size = estimate_size(profile)
+		self._items[profile.guid] = (profile, size)
+		self.size_bytes += size
+		while len(self._items) > 1 and (len(self._items) > self.max_profiles or self.size_bytes > self.max_bytes):
+			guid, (prof, size) = self._items.popitem(last=False)
+			self.size_bytes -= size
+			self.evictions += 1
+			self.log.dbg(f"Evicted profile '{prof.name}' ({size} B) from memory")
+
+	def remove(self, guid):
+		if (item := self._items.pop(guid, None)):
+			self.size_bytes -= item[1]
+
+	def clear(self):
+		self._items.clear()
+		self.size_bytes = 0
+
+	def stats(self):
+		return {
+			'profiles': len(self._items), 'bytes': self.size_bytes, 'hits': self.hits,
+			'misses': self.misses, 'evictions': self.evictions
+		}
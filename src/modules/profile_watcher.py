@@ -1,7 +1,8 @@
 '''
 ProfileWatcher is a file system change monitor for detecting modifications
-in a single directory. On Windows it uses Win32 API to wait for events,
-otherwise it falls back to periodic scanning.
+in one or more directories, all handled from a single thread. On Windows it
+uses Win32 API to wait for events and on Linux it uses inotify, otherwise it
+falls back to periodic scanning.
 '''
 
 __copyright__ = '''
@@ -22,98 +23,618 @@ A copy of the GNU General Public License is available at <http://www.gnu.org/lic
 
 import os
 import sys
-from threading import Timer, Thread, Event
+import select
+import struct
+import ctypes
+import ctypes.util
+from collections import namedtuple
+from fnmatch import fnmatch
+from threading import Thread, Event, Condition, RLock
+from time import monotonic, perf_counter, time
 from logging import getLogger
 import modules.utils as utils
 
-__all__ = ['watch_profiles', 'WatcherThread']
+if sys.platform == "win32":
+	try:
+		import win32file
+		import win32event
+		import win32con
+	except ImportError:
+		win32file = None
+else:
+	win32file = None
+
+__all__ = ['WatcherService', 'WatcherStats', 'WatchRoot', 'AdaptiveInterval', 'ChangeSet', 'DirSnapshot', 'FileStat']
+
+
+class Inotify():
+	'''
+	Minimal ctypes wrapper around the Linux inotify API.
+	`read()` returns a list of `(watch descriptor, event mask, file name)` tuples.
+	`wake()` may be called from any thread to make a pending `read()` return early.
+	'''
+	IN_CLOSE_WRITE = 0x00000008
+	IN_MOVED_FROM  = 0x00000040
+	IN_MOVED_TO    = 0x00000080
+	IN_DELETE      = 0x00000200
+	IN_DELETE_SELF = 0x00000400
+	IN_MOVE_SELF   = 0x00000800
+	IN_Q_OVERFLOW  = 0x00004000
+	IN_IGNORED     = 0x00008000
+	IN_ONLYDIR     = 0x01000000
+	EVENT_HDR = struct.Struct("iIII")  # struct inotify_event { int wd; uint32_t mask, cookie, len; char name[]; }
+
+	def __init__(self):
+		self.fd = -1
+		self._wake_r = self._wake_w = -1
+		self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+		self._libc.inotify_add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+		self._libc.inotify_rm_watch.argtypes = (ctypes.c_int, ctypes.c_int)
+		self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+		if self.fd < 0:
+			err = ctypes.get_errno()
+			raise OSError(err, os.strerror(err))
+		self._wake_r, self._wake_w = os.pipe()
+		os.set_blocking(self._wake_r, False)
+		os.set_blocking(self._wake_w, False)
 
+	def add_watch(self, path, mask):
+		wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask | self.IN_ONLYDIR)
+		if wd < 0:
+			err = ctypes.get_errno()
+			raise OSError(err, os.strerror(err), path)
+		return wd
 
-def watch_profiles(path, stop_event, interval = 2.0, ext = ".xml"):
+	def rm_watch(self, wd):
+		self._libc.inotify_rm_watch(self.fd, wd)
 
-	def files_to_timestamp():
-		ret = {}
-		with os.scandir(path) as it:
-			for entry in it:
-				if entry.is_file and entry.name.endswith(ext):
-					ret[entry.path] = entry.stat().st_mtime_ns
+	def wake(self):
+		try:
+			os.write(self._wake_w, b"\0")
+		except OSError:
+			pass  # pipe is full, which means a wake-up is already pending
+
+	def read(self, timeout):
+		ret = []
+		ready = select.select([self.fd, self._wake_r], [], [], timeout)[0]
+		if self._wake_r in ready:
+			try:
+				while os.read(self._wake_r, 512): pass
+			except BlockingIOError:
+				pass
+		if self.fd not in ready:
+			return ret
+		try:
+			buf = os.read(self.fd, 64 * 1024)
+		except BlockingIOError:
+			return ret
+		pos = 0
+		while pos + self.EVENT_HDR.size <= len(buf):
+			wd, mask, _, nlen = self.EVENT_HDR.unpack_from(buf, pos)
+			pos += self.EVENT_HDR.size
+			name = os.fsdecode(buf[pos:pos+nlen].rstrip(b"\0"))
+			pos += nlen
+			ret.append((wd, mask, name))
 		return ret
 
-	log = utils.Logger(getLogger(__name__))
-	usewin32 = sys.platform == "win32"
-	if usewin32:
+	def close(self):
+		for fd in (self.fd, self._wake_r, self._wake_w):
+			if fd > -1:
+				os.close(fd)
+		self.fd = self._wake_r = self._wake_w = -1
+
+
+# Subset of os.stat_result members recorded for each watched file. The member names match
+# os.stat_result so these can be passed to anything which expects one of those.
+FileStat = namedtuple('FileStat', ('st_ino', 'st_size', 'st_mtime_ns'))
+
+def file_stat(path):
+	st = os.stat(path)
+	return FileStat(st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+class DirSnapshot():
+	'''
+	The state of all files in a directory with names matching a `fnmatch`-style `pattern`, as `{'path': FileStat, ...}`,
+	taken with a single `scandir()` pass (and one `stat()` per file, which is free on Windows).
+	'''
+	MIN_MTIME_DELTA = 50000000  # [ns] ignore modification time changes this small, if size and inode are the same
+
+	def __init__(self, path=None, pattern="*.xml"):
+		self.files = {}
+		if path:
+			with os.scandir(path) as it:
+				for entry in it:
+					if entry.is_file() and fnmatch(entry.name, pattern):
+						st = entry.stat()
+						self.files[entry.path] = FileStat(st.st_ino, st.st_size, st.st_mtime_ns)
+
+	def diff(self, newer):
+		'''Returns lists of `(added, modified, removed)` files in the `newer` snapshot compared to this one.'''
+		added, modified, removed = [], [], []
+		files = self.files
+		found = 0
+		for f, st in newer.files.items():
+			if (old := files.get(f)) is None:
+				added.append(f)
+				continue
+			found += 1
+			if st.st_size != old.st_size or st.st_ino != old.st_ino or st.st_mtime_ns - old.st_mtime_ns > self.MIN_MTIME_DELTA:
+				modified.append(f)
+		if found < len(files):
+			removed = [f for f in files.keys() if f not in newer.files]
+		return added, modified, removed
+
+
+class AdaptiveInterval():
+	'''
+	A polling interval which adapts to activity. After any `poke()` it stays at `fast` for `hold` seconds,
+	then backs off exponentially by `factor` on each call to `next()` until it reaches `slow`.
+	'''
+	def __init__(self, slow, fast = 0.1, hold = 10.0, factor = 2.0):
+		self.slow = slow
+		self.fast = fast
+		self.hold = hold
+		self.factor = factor
+		self.current = min(fast, slow)
+		self._active_until = monotonic() + hold
+
+	def poke(self):
+		self._active_until = monotonic() + self.hold
+		self.current = min(self.fast, self.slow)
+
+	def next(self):
+		if monotonic() < self._active_until:
+			self.current = min(self.fast, self.slow)
+		else:
+			self.current = min(self.current * self.factor, self.slow)
+		return self.current
+
+
+class ChangeSet():
+	'''
+	Accumulates batches of `(added, modified, removed, stats)` changes, merging repeated changes to the
+	same file: added + modified = added, modified + removed = removed, added + removed = nothing,
+	removed + added = modified. Files keep the order in which they were first reported.
+	'''
+	ADDED, MODIFIED, REMOVED = range(3)
+	MERGE = {
+		(ADDED, ADDED): ADDED,       (ADDED, MODIFIED): ADDED,       (ADDED, REMOVED): None,
+		(MODIFIED, ADDED): MODIFIED, (MODIFIED, MODIFIED): MODIFIED, (MODIFIED, REMOVED): REMOVED,
+		(REMOVED, ADDED): MODIFIED,  (REMOVED, MODIFIED): MODIFIED,  (REMOVED, REMOVED): REMOVED,
+	}
+
+	def __init__(self):
+		self._changes = {}   # { 'path' : change type, ... }
+		self._stats = {}
+
+	def __bool__(self):
+		return bool(self._changes)
+
+	def add(self, added, modified, removed, stats=None):
+		for kind, files in ((self.ADDED, added), (self.MODIFIED, modified), (self.REMOVED, removed)):
+			for f in files:
+				if (prev := self._changes.get(f)) is not None:
+					kind_ = self.MERGE[(prev, kind)]
+					if kind_ is None:
+						del self._changes[f]
+						continue
+				else:
+					kind_ = kind
+				self._changes[f] = kind_
+		if stats:
+			self._stats.update(stats)
+
+	def take(self):
+		'''Returns the merged changes as `(added, modified, removed, stats)` and resets this set.'''
+		ret = ([], [], [])
+		for f, kind in self._changes.items():
+			ret[kind].append(f)
+		stats = {f: self._stats[f] for f in ret[0] + ret[1] if f in self._stats}
+		self._changes = {}
+		self._stats = {}
+		return (*ret, stats)
+
+
+class WatcherStats():
+	'''
+	Counters and timings collected by `WatcherService`, with all times in seconds. The `latency` is measured from
+	a file's modification time to the delivery of the change to the callback, so it includes any debounce delay.
+	'''
+	def __init__(self):
+		self.reset()
+
+	def reset(self):
+		self.since = monotonic()
+		self.scans = 0              # directory snapshots taken
+		self.scan_time = 0.0
+		self.scan_time_max = 0.0
+		self.files_scanned = 0
+		self.files_last_scan = 0
+		self.native_events = 0      # raw change notifications from inotify or Win32
+		self.events = [0, 0, 0]     # files delivered as [added, modified, removed]
+		self.batches = 0            # callback invocations
+		self.callback_time = 0.0
+		self.latency_count = 0
+		self.latency_total = 0.0
+		self.latency_max = 0.0
+
+	def addScan(self, duration, files):
+		self.scans += 1
+		self.scan_time += duration
+		self.scan_time_max = max(self.scan_time_max, duration)
+		self.files_scanned += files
+		self.files_last_scan = files
+
+	def addBatch(self, changes, duration):
+		self.batches += 1
+		self.callback_time += duration
+		for kind in (ChangeSet.ADDED, ChangeSet.MODIFIED, ChangeSet.REMOVED):
+			self.events[kind] += len(changes[kind])
+
+	def addLatency(self, latency):
+		self.latency_count += 1
+		self.latency_total += latency
+		self.latency_max = max(self.latency_max, latency)
+
+	def as_dict(self):
+		return {
+			'period': monotonic() - self.since,
+			'scans': self.scans,
+			'scan_time_avg': self.scan_time / self.scans if self.scans else 0.0,
+			'scan_time_max': self.scan_time_max,
+			'files_per_scan': self.files_scanned / self.scans if self.scans else 0.0,
+			'files_last_scan': self.files_last_scan,
+			'native_events': self.native_events,
+			'added': self.events[ChangeSet.ADDED],
+			'modified': self.events[ChangeSet.MODIFIED],
+			'removed': self.events[ChangeSet.REMOVED],
+			'batches': self.batches,
+			'callback_time': self.callback_time,
+			'latency_avg': self.latency_total / self.latency_count if self.latency_count else 0.0,
+			'latency_max': self.latency_max,
+		}
+
+	def __str__(self):
+		d = self.as_dict()
+		return (f"{d['period']:.0f}s: {d['scans']} scans (avg {d['scan_time_avg'] * 1000:.2f}ms, max {d['scan_time_max'] * 1000:.2f}ms, "
+		        f"{d['files_per_scan']:.1f} files); {d['native_events']} native events; added/modified/removed: "
+		        f"{d['added']}/{d['modified']}/{d['removed']} in {d['batches']} batches ({d['callback_time'] * 1000:.1f}ms); "
+		        f"latency avg {d['latency_avg'] * 1000:.0f}ms, max {d['latency_max'] * 1000:.0f}ms")
+
+
+class WatchRoot():
+	'''
+	One directory watched by `WatcherService`. Files in `path` with names matching the `fnmatch`-style
+	`pattern` are tracked in `snapshot` and changes to them are delivered to `callback(added, modified, removed, stats)`.
+	'''
+	def __init__(self, name, path, pattern, callback):
+		self.name = name
+		self.path = path
+		self.pattern = pattern
+		self.callback = callback
+		self.snapshot = DirSnapshot()
+		self.pending = ChangeSet()
+		self.native = None   # inotify watch descriptor or Win32 change notification handle, `None` if polled
+
+	def rescan(self, stats=None):
+		'''
+		Takes a new snapshot and returns the changes since the last one as `(added, modified, removed, stats)`.
+		The scan is recorded in `stats` (a `WatcherStats`), if given.
+		'''
+		t = perf_counter()
 		try:
-			import win32file
-			import win32event
-			import win32con
-			iInterval = int(interval * 1000)
-			change_handle = win32file.FindFirstChangeNotification(
-				path, False, win32con.FILE_NOTIFY_CHANGE_FILE_NAME | win32con.FILE_NOTIFY_CHANGE_LAST_WRITE
-			)
-		except Exception as e:
-			log.err(f"Win32 error, reverting to polling mode. Error: {repr(e)}")
-			usewin32 = False
+			after = DirSnapshot(self.path, self.pattern)
+		except FileNotFoundError:
+			after = DirSnapshot()
+		if stats:
+			stats.addScan(perf_counter() - t, len(after.files))
+		changes = (*self.snapshot.diff(after), after.files)
+		self.snapshot = after
+		return changes
 
-	log.dbg(f"Watching {path} [interval: {interval:.02f}s, Win32: {usewin32}]")
 
-	before = files_to_timestamp()
-	try:
-		while not stop_event.is_set():
-			if usewin32:
-				wait_result = win32event.WaitForSingleObject(change_handle, iInterval)
-				if wait_result != win32con.WAIT_OBJECT_0:
-					continue
-			elif stop_event.wait(timeout=interval):
-				break
-
-			after = files_to_timestamp()
-			added = [f for f in after.keys() if not f in before.keys()]
-			removed = []
-			modified = []
-			# modified = {}
-			for (f, m) in before.items():
-				if not f in after.keys():
-					removed.append(f)
-				elif (os.stat(f).st_mtime_ns - m) > 50000000:  # ignore <= 50ms deltas
-					modified.append(f)
-			if added or modified or removed:
-				# log.dbg('Modified: {}'.format(', '.join(modified)))
-				# log.dbg('Removed: {}'.format(', '.join(removed)))
-				yield (added, modified, removed)
-
-			before = after
-			if usewin32:
-				win32file.FindNextChangeNotification(change_handle)
-		#
-	except Exception as e:
-		log.err(f"Exception in file system watcher, exiting: {repr(e)}")
-	else:
-		log.dbg("File watcher got IRQ, stopping")
-	finally:
-		if usewin32:
-			win32file.FindCloseChangeNotification(change_handle)
-
-
-class WatcherThread(Thread):
-	def __init__(self, path, mod_callback, interval = 2.0, ext = ".xml"):
-		super(WatcherThread, self).__init__(daemon=True)
+class WatcherService(Thread):
+	'''
+	Watches any number of directories (see `watch()`) from one thread, using native change notifications where
+	available and polling every `interval` seconds otherwise. The roots and interval can be changed at any time
+	without losing the snapshots of the directories which are still watched.
+
+	Changes are collected until no new ones have arrived for `debounce` seconds (but not longer than
+	`DEBOUNCE_MAX_FACTOR * debounce`), merged per root with `ChangeSet`, and delivered one batch at a time
+	from a single dispatcher thread.
+	If `adaptive` is `True` then polling speeds up after changes or `poke()` calls,
+	using `interval` as the slowest rate (see `AdaptiveInterval`).
+	Counters and timings are kept in `stats` (see `WatcherStats`) and, if `stats_interval` is > 0,
+	logged at debug level every that many seconds.
+	'''
+	DEBOUNCE_MAX_FACTOR = 10
+	INOTIFY_MASK = (Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_TO | Inotify.IN_MOVED_FROM | Inotify.IN_DELETE |
+	                Inotify.IN_DELETE_SELF | Inotify.IN_MOVE_SELF)
+
+	def __init__(self, interval = 2.0, debounce = 0.05, adaptive = False, stats_interval = 0.0):
+		super(WatcherService, self).__init__(daemon=True)
+		self.log = utils.Logger(getLogger(__name__))
 		self.stop_event = Event()
-		self.path = path
-		self.mod_callback = mod_callback
 		self.interval = interval
-		self.filter_ext = ext
+		self.debounce = debounce
+		self.adaptive = AdaptiveInterval(interval) if adaptive else None
+		self.stats = WatcherStats()
+		self.stats_interval = stats_interval
+		self._lock = RLock()
+		self._cond = Condition(self._lock)
+		self._roots = {}        # { 'name' : WatchRoot, ... }
+		self._by_wd = {}        # { inotify wd : [WatchRoot, ...], ... }
+		self._wake = Event()
+		self._next_poll = 0.0
+		self._last_change = 0.0
+		self._finished = False
+		self._dispatcher = Thread(target=self._dispatch, daemon=True)
+		self._inotify = None
+		self._win32_wake = None
+		self._win32_closing = []   # change handles to close once the watcher thread is no longer waiting on them
+		if win32file:
+			try:
+				self._win32_wake = win32event.CreateEvent(None, False, False, None)
+			except Exception as e:
+				self.log.err(f"Win32 error, reverting to polling mode. Error: {repr(e)}")
+		elif sys.platform.startswith("linux"):
+			try:
+				self._inotify = Inotify()
+			except Exception as e:
+				self.log.err(f"inotify error, reverting to polling mode. Error: {repr(e)}")
+
+	def watch(self, name, path, callback, pattern = "*.xml"):
+		'''
+		Starts watching files matching `pattern` in the `path` directory, delivering changes to `callback`.
+		If a root with the same `name` already exists for the same path and pattern only its callback is
+		replaced, otherwise it is replaced by the new one.
+		'''
+		with self._lock:
+			if (root := self._roots.get(name)):
+				if root.path == path and root.pattern == pattern:
+					root.callback = callback
+					return
+				self._unwatch(root)
+			root = WatchRoot(name, path, pattern, callback)
+			self._roots[name] = root
+			# start native monitoring before the initial scan so no changes are missed in between
+			self._add_native(root)
+			root.rescan(self.stats)
+		self.log.dbg(f"Watching {path} for {pattern} [native: {root.native is not None}, files: {len(root.snapshot.files)}]")
+		self._signal()
+
+	def unwatch(self, name):
+		with self._lock:
+			if (root := self._roots.get(name)):
+				self._unwatch(root)
+		self._signal()
+
+	def roots(self):
+		'''Returns a dict of `{'name': (path, pattern)}` for all watched roots.'''
+		with self._lock:
+			return {name: (root.path, root.pattern) for name, root in self._roots.items()}
+
+	def set_interval(self, interval, adaptive = None):
+		'''Changes the polling interval and, if `adaptive` is not `None`, whether adaptive polling is used.'''
+		with self._lock:
+			self.interval = interval
+			if adaptive is not None and adaptive != (self.adaptive is not None):
+				self.adaptive = AdaptiveInterval(interval) if adaptive else None
+			elif self.adaptive:
+				self.adaptive.slow = interval
+			self._next_poll = min(self._next_poll, monotonic() + interval)
+		self._signal()
+
+	def poke(self):
+		'''Notifies the watcher of activity which may lead to file changes soon.'''
+		if self.adaptive:
+			with self._lock:
+				self.adaptive.poke()
+				self._next_poll = 0.0
+			self._signal()
 
 	def run(self):
-		watch = watch_profiles(
-			self.path,
-			self.stop_event,
-			self.interval,
-			self.filter_ext
-		)
-		for result in watch:
-			# delay 5ms otherwise files may still be unreadable
-			Timer(0.005, self.mod_callback, (result[0], result[1], result[2])).start()
+		self._dispatcher.start()
+		self.log.dbg(f"File watcher started [interval: {self.interval:.02f}s, adaptive: {self.adaptive is not None}, "
+		             f"Win32: {self._win32_wake is not None}, inotify: {self._inotify is not None}]")
+		next_stats = monotonic() + self.stats_interval
+		try:
+			while not self.stop_event.is_set():
+				with self._lock:
+					if monotonic() >= self._next_poll:
+						self._poll()
+						self._next_poll = monotonic() + (self.adaptive.next() if self.adaptive else self.interval)
+					timeout = max(0.0, self._next_poll - monotonic())
+				if self.stats_interval > 0.0:
+					if monotonic() >= next_stats:
+						self.log.dbg(f"File watcher stats for last {self.stats}")
+						self.stats.reset()
+						next_stats = monotonic() + self.stats_interval
+					timeout = min(timeout, max(0.0, next_stats - monotonic()))
+				if self._win32_wake:
+					self._wait_win32(timeout)
+				elif self._inotify:
+					self._wait_inotify(timeout)
+				else:
+					self._wake.wait(timeout)
+					self._wake.clear()
+			#
+		except Exception as e:
+			self.log.err(f"Exception in file system watcher, exiting: {repr(e)}")
+		else:
+			self.log.dbg("File watcher got IRQ, stopping")
+		finally:
+			with self._cond:
+				for root in list(self._roots.values()):
+					self._unwatch(root)
+				self._close_win32_handles()
+				if self._win32_wake:
+					win32file.CloseHandle(self._win32_wake)
+					self._win32_wake = None
+				if self._inotify:
+					self._inotify.close()
+					self._inotify = None
+				self._finished = True
+				self._cond.notify()
 
 	def join(self, timeout=None):
 		self.stop_event.set()
+		self._signal()
+		with self._cond:
+			self._finished = True
+			self._cond.notify()
 		super().join(timeout)
+		if self._dispatcher.is_alive():
+			self._dispatcher.join(timeout)
+
+	def _signal(self):
+		self._wake.set()
+		if self._inotify:
+			self._inotify.wake()
+		elif self._win32_wake:
+			win32event.SetEvent(self._win32_wake)
+
+	def _add_native(self, root):
+		try:
+			if self._inotify:
+				root.native = self._inotify.add_watch(root.path, self.INOTIFY_MASK)
+				self._by_wd.setdefault(root.native, []).append(root)
+			elif self._win32_wake:
+				root.native = win32file.FindFirstChangeNotification(
+					root.path, False, win32con.FILE_NOTIFY_CHANGE_FILE_NAME | win32con.FILE_NOTIFY_CHANGE_LAST_WRITE
+				)
+		except Exception as e:
+			self.log.warn(f"Could not monitor {root.path}, reverting to polling mode for it. Error: {repr(e)}")
+			root.native = None
+
+	def _remove_native(self, root):
+		if root.native is None:
+			return
+		if self._inotify:
+			if (roots := self._by_wd.get(root.native)):
+				if root in roots:
+					roots.remove(root)
+				if not roots:
+					del self._by_wd[root.native]
+					self._inotify.rm_watch(root.native)
+		elif self._win32_wake:
+			self._win32_closing.append(root.native)
+		root.native = None
+
+	def _unwatch(self, root):
+		self._remove_native(root)
+		if self._roots.get(root.name) is root:
+			del self._roots[root.name]
+
+	def _poll(self):
+		# rescans all the roots without native change monitoring
+		changed = False
+		for root in list(self._roots.values()):
+			if root.native is None:
+				changed = self._deliver(root, root.rescan(self.stats)) or changed
+		if changed and self.adaptive:
+			self.adaptive.poke()
+
+	def _deliver(self, root, changes):
+		# queues changes for the dispatcher thread; returns True if there were any
+		if not (changes[0] or changes[1] or changes[2]):
+			return False
+		with self._cond:
+			root.pending.add(*changes)
+			self._last_change = monotonic()
+			self._cond.notify()
+		return True
+
+	def _wait_inotify(self, timeout):
+		if not (events := self._inotify.read(timeout)) or self.stop_event.is_set():
+			return
+		self.stats.native_events += len(events)
+		with self._lock:
+			changesets = {}
+			rescan = set()
+			for wd, mask, name in events:
+				if mask & Inotify.IN_Q_OVERFLOW:
+					self.log.warn("inotify queue overflow, rescanning all watched folders.")
+					rescan.update(root.name for root in self._roots.values() if root.native is not None)
+					continue
+				if not (roots := self._by_wd.get(wd)):
+					continue
+				if mask & (Inotify.IN_DELETE_SELF | Inotify.IN_MOVE_SELF | Inotify.IN_IGNORED):
+					for root in list(roots):
+						self.log.warn(f"Watched folder {root.path} was removed or moved, reverting to polling mode for it.")
+						self._remove_native(root)
+						rescan.add(root.name)
+					continue
+				for root in roots:
+					if not fnmatch(name, root.pattern):
+						continue
+					cs = changesets.setdefault(root.name, ChangeSet())
+					f = os.path.join(root.path, name)
+					if mask & (Inotify.IN_DELETE | Inotify.IN_MOVED_FROM):
+						if root.snapshot.files.pop(f, None) is not None:
+							cs.add((), (), (f,))
+						continue
+					try:
+						st = file_stat(f)
+					except OSError:
+						continue  # already gone again
+					if f in root.snapshot.files:
+						cs.add((), (f,), (), {f: st})
+					else:
+						cs.add((f,), (), (), {f: st})
+					root.snapshot.files[f] = st
+			for name, cs in changesets.items():
+				if (root := self._roots.get(name)):
+					self._deliver(root, cs.take())
+			for name in rescan:
+				if (root := self._roots.get(name)):
+					self._deliver(root, root.rescan(self.stats))
+
+	def _wait_win32(self, timeout):
+		with self._lock:
+			self._close_win32_handles()
+			roots = [root for root in self._roots.values() if root.native is not None]
+			handles = [self._win32_wake] + [root.native for root in roots]
+		result = win32event.WaitForMultipleObjects(handles, False, int(timeout * 1000))
+		if self.stop_event.is_set() or not (win32con.WAIT_OBJECT_0 < result < win32con.WAIT_OBJECT_0 + len(handles)):
+			return
+		self.stats.native_events += 1
+		root = roots[result - win32con.WAIT_OBJECT_0 - 1]
+		with self._lock:
+			if root.native is not None and self._roots.get(root.name) is root:
+				self._deliver(root, root.rescan(self.stats))
+				win32file.FindNextChangeNotification(root.native)
+
+	def _close_win32_handles(self):
+		for handle in self._win32_closing:
+			try:
+				win32file.FindCloseChangeNotification(handle)
+			except Exception:
+				pass
+		self._win32_closing = []
+
+	def _dispatch(self):
+		while True:
+			with self._cond:
+				while not self._finished and not any(root.pending for root in self._roots.values()):
+					self._cond.wait()
+				if self._finished:
+					return
+				# wait for things to settle down; this also gives the writer a chance to finish with the files
+				deadline = monotonic() + self.debounce * self.DEBOUNCE_MAX_FACTOR
+				while not self._finished and (remaining := min(self._last_change + self.debounce, deadline) - monotonic()) > 0:
+					self._cond.wait(remaining)
+				if self._finished:
+					return
+				batches = [(root.callback, root.pending.take()) for root in self._roots.values() if root.pending]
+			for callback, changes in batches:
+				now = time()
+				for st in changes[3].values():
+					self.stats.addLatency(max(0.0, now - st.st_mtime_ns / 1e9))
+				t = perf_counter()
+				try:
+					callback(*changes)
+				except Exception as e:
+					self.log.err(f"Exception in file change callback: {repr(e)}")
+				self.stats.addBatch(changes, perf_counter() - t)
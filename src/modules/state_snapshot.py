@@ -0,0 +1,68 @@
+'''
+StateSnapshot persists the last state values sent to TouchPortal, so they can
+be restored right away on the next start, before any profiles are loaded.
+'''
+
+__copyright__ = '''
+This file is part of the LGKeys TouchPortal Plugin project
+Copyright Maxim Paperno; all rights reserved.
+
+This file may be used under the terms of the GNU
+General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+A copy of the GNU General Public License is available at <http://www.gnu.org/licenses/>.
+'''
+
+import os
+import json
+from logging import getLogger
+import modules.utils as utils
+
+__all__ = ['StateSnapshot']
+
+
+class StateSnapshot():
+	'''
+	Reads and writes a snapshot dict as a JSON file. Writes go to a temporary file which is then moved
+	into place, so a crash never leaves a half-written snapshot behind.
+
+	Args:
+		`fn` (str): Full path of the snapshot file.
+	'''
+	VERSION = 1   # bump whenever the snapshot contents change
+
+	def __init__(self, fn):
+		self.log = utils.Logger(getLogger(__name__))
+		self.fn = fn
+		self.dirty = False
+
+	def load(self):
+		'''Returns the saved snapshot dict, or `None` if there isn't a valid one.'''
+		if not self.fn or not os.path.isfile(self.fn):
+			return None
+		try:
+			with open(self.fn, 'r', encoding='utf-8') as f:
+				data = json.load(f)
+			if isinstance(data, dict) and data.get('version') == self.VERSION:
+				return data
+			self.log.info(f"Ignoring state snapshot {self.fn} from a different version.")
+		except Exception as e:
+			self.log.warn(f"Could not load state snapshot {self.fn}. Error: {repr(e)}")
+		return None
+
+	def save(self, data):
+		if not self.fn:
+			return
+		try:
+			data = {'version': self.VERSION, **data}
+			utils.write_file_atomic(self.fn, lambda f: json.dump(data, f, separators=(',', ':')), 'w', encoding='utf-8')
+			self.dirty = False
+			self.log.dbg(f"Saved state snapshot to {self.fn}")
+		except Exception as e:
+			self.log.warn(f"Could not save state snapshot {self.fn}. Error: {repr(e)}")
@@ -1,5 +1,7 @@
 
 import json
+import os
+from tempfile import mkstemp
 
 class Logger:
   def __init__(self, logger):
@@ -12,3 +14,18 @@ class Logger:
 
   def format_json(self, data):
     return json.dumps(data, indent=2)
+
+def write_file_atomic(fn, write, mode='w', **kwargs):
+  '''
+  Calls `write(f)` with a temporary file in the same folder as `fn` and then moves it into place,
+  so `fn` is never left half-written. `mode` and `kwargs` are passed on to `open()`. Raises on failure.
+  '''
+  fd, tmp = mkstemp(prefix=os.path.basename(fn) + ".", dir=os.path.dirname(fn) or None)
+  try:
+    with os.fdopen(fd, mode, **kwargs) as f:
+      write(f)
+    os.replace(tmp, fn)
+  except BaseException:
+    try: os.remove(tmp)
+    except OSError: pass
+    raise